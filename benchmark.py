@@ -0,0 +1,284 @@
+'''
+Measures how quickly the geolocation pipeline runs, either over the sample files in data_to_geolocate/ or over
+synthetic localities generated from the surveyor general farms, e.g.,
+    python benchmark.py
+    python benchmark.py --synthetic 100000 --seed 1 --compare
+
+It reports rows/sec, latency percentiles for each stage and peak memory, and uses an offline stand-in for google so it
+doesn't need a network. Each run is appended to benchmark_results.jsonl along with the commit it ran on, and --compare
+shows the change since the last saved run over the same input.
+'''
+
+import argparse, contextlib, csv, glob, json, os, platform, random, re, subprocess, sys, time
+from collections import Counter, defaultdict
+from location import FeatureTypes, Provinces, province_for_file
+from distances import apply_directions, numpy
+from geocoding import BatchGeocoder, OfflineGeocoder
+from geolocator import make_locality
+from geolocation_memo import GeolocationMemo
+from indexes import make_database, cell_to_qds, qds_to_cells
+from instrumentation import summarise
+from locality_parser import parse_locality
+from reference_data import ENCODING, load_farms
+from snapshot import load_snapshot
+from main import batches
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+RESULTS_FILE = 'benchmark_results.jsonl'
+
+# How often the generator produces each kind of locality
+SYNTHETIC_KINDS = [('name', 30), ('farm', 15), ('directions', 20), ('degrees', 10), ('noise', 15), ('junk', 10)]
+BEARINGS = ['N', 'S', 'E', 'W', 'NE', 'NW', 'SE', 'SW', 'NNE', 'ESE', 'SSW', 'WNW']
+UNITS = ['km', 'km', 'km', 'kms', 'miles', 'm']
+
+
+def read_sample(path):
+    with open(path, newline='') as csv_file:
+        return list(csv.DictReader(csv_file, delimiter=',', quotechar='"'))
+
+
+def _degrees(value, hemisphere):
+    value = abs(value)
+    minutes, seconds = divmod(round(value * 3600), 60)
+    degrees, minutes = divmod(minutes, 60)
+    return '%02dd%02dm%02ds%s' % (degrees, minutes, seconds, hemisphere)
+
+
+def _misspell(name, rand):
+    # Drops, doubles or swaps a letter
+    if len(name) < 4:
+        return name
+    i = rand.randrange(1, len(name) - 2)
+    mistake = rand.choice(['drop', 'double', 'swap'])
+    if mistake == 'drop':
+        return name[:i] + name[i + 1:]
+    if mistake == 'double':
+        return name[:i] + name[i] + name[i:]
+    return name[:i] + name[i + 1] + name[i] + name[i + 2:]
+
+
+def synthetic_localities(count, seed=0, reference_csv='surveyor_general.csv'):
+    '''
+    Yields count rows (like the input csv's, with a Locality and Locus) made from random surveyor general farms: the
+    bare name, farm numbers, directions, degree coordinates, misspellings and junk nobody could find. The same seed
+    always gives the same rows.
+    '''
+    farms = []
+    with open(reference_csv, encoding=ENCODING) as f:
+        entries = list(csv.reader(f))[1:]
+    for entry in entries:
+        reference = re.match(r'^(\d{4}[A-D]{2})_(\d+)', entry[2].strip())
+        if reference and entry[1].strip():
+            farms.append((entry[1].strip(), reference.group(1), reference.group(2), float(entry[4]), float(entry[5])))
+
+    rand = random.Random(seed)
+    kinds = [kind for kind, weight in SYNTHETIC_KINDS for i in range(weight)]
+    for i in range(count):
+        name, qds, number, lat, long = rand.choice(farms)
+        kind = rand.choice(kinds)
+        if kind == 'name':
+            locality = rand.choice([name, name.upper(), name.lower()])
+        elif kind == 'farm':
+            locality = rand.choice(['Farm ' + name + ' ' + number, name + ' ' + number, name + ' farm'])
+        elif kind == 'directions':
+            distance = str(rand.randint(1, 80)) if rand.random() < 0.8 else '%.1f' % (rand.random() * 20)
+            bearing, unit = rand.choice(BEARINGS), rand.choice(UNITS)
+            locality = rand.choice([distance + ' ' + unit + ' ' + bearing + ' of ' + name,
+                                    distance + ' ' + unit + ' ' + bearing + ' ' + name,
+                                    name + ', ' + distance + ' ' + unit + ' ' + bearing])
+        elif kind == 'degrees':
+            locality = name + ' ' + _degrees(lat, 'S') + ' ' + _degrees(long, 'E')
+        elif kind == 'noise':
+            locality = _misspell(name, rand) + rand.choice(['', '.', ',', ' ?', ' (farm)', ' area'])
+        else:
+            locality = ' '.join(''.join(rand.choice('abcdefghijklmnoprstuvwz') for j in range(rand.randint(3, 9)))
+                                for k in range(rand.randint(1, 3))).capitalize()
+
+        # Most records are in the farm's QDS, the rest are a square or two off
+        if rand.random() < 0.2:
+            row, column = sorted(qds_to_cells(qds))[0]
+            qds = cell_to_qds((row + rand.randint(-2, 2), column + rand.randint(-2, 2)))
+        yield {'Locality': locality, 'Locus': qds}
+
+
+def peak_memory_mb():
+    '''
+    The most memory this process has used so far, None where we can't tell (e.g., Windows)
+    '''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def load_benchmark_databases(province, reference):
+    '''
+    The databases and the places the offline geocoder knows, from the snapshot main.py uses or from the surveyor
+    general farms alone (which ship with the repo)
+    '''
+    if reference == 'snapshot':
+        databases, gazetteer = load_snapshot(province)
+        return databases, gazetteer
+    farms = load_farms(province)
+    return [make_database(farms, FeatureTypes.farm, "Farms")], farms
+
+
+def run_pipeline(rows, province, databases, batch_geocoder, memo=None, batch_size=50):
+    '''
+    Geolocates the rows the way main.py does (without writing the output), timing each stage.
+    parse is cleaning the locality, match is the whole database stage for a row (which cleans it again), geocode and
+    directions are per batch. Returns the timings for each stage and how each row was resolved. Rows whose QDS can't be
+    read are counted as 'bad qds' and left out, main.py stops on them.
+    '''
+    timings = defaultdict(list)
+    tiers = Counter()
+    for lines in batches(rows, batch_size):
+        results = []
+        for line in lines:
+            qds = line['Locus'].strip()
+            start = time.perf_counter()
+            parse_locality(line['Locality'].strip())
+            timings['parse'].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            try:
+                locality = make_locality(province, line['Locality'], qds)
+            except ValueError:
+                tiers['bad qds'] += 1
+                continue
+            results.append([locality, locality.geolocate(databases, google=None, directions_in_bulk=True, memo=memo)])
+            timings['match'].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        pending = [result for result in results if result[0].needs_geocoder]
+        geocoded = batch_geocoder.geocode_all([locality.geocoder_query() for locality, temp in pending])
+        for result, geocoder_result in zip(pending, geocoded):
+            result[1] = result[0].resolve_geocoder_result(geocoder_result, directions_in_bulk=True)
+        timings['geocode'].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        apply_directions([(temp, locality.directions) for locality, temp in results])
+        timings['directions'].append(time.perf_counter() - start)
+
+        for locality, temp in results:
+            tiers[temp.match_tier.value if temp and temp.match_tier else 'not found'] += 1
+    return timings, tiers
+
+
+def current_commit():
+    '''
+    The commit we're benchmarking and whether there are uncommitted changes, so saved results can be told apart
+    '''
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL)
+        status = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                         stderr=subprocess.DEVNULL)
+        return commit.decode().strip(), bool(status.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def previous_result(result, path=RESULTS_FILE):
+    '''
+    The last saved result over the same input and reference data
+    '''
+    if not os.path.exists(path):
+        return None
+    previous = None
+    with open(path) as f:
+        for line in f:
+            saved = json.loads(line)
+            if saved['input'] == result['input'] and saved['reference'] == result['reference']:
+                previous = saved
+    return previous
+
+
+def print_result(result, previous=None):
+    def change(new, old):
+        if not old:
+            return ''
+        return ' (%+.1f%% vs %s)' % ((new - old) / old * 100, previous['commit'] or previous['timestamp'])
+
+    print('%s: %d rows in %.2fs, %.1f rows/sec%s' % (result['input'], result['rows'], result['seconds'],
+                                                    result['rows_per_second'],
+                                                    change(result['rows_per_second'],
+                                                           previous and previous['rows_per_second'])))
+    print('Loading reference data took %.2fs, peak memory %s MB' % (
+        result['load_seconds'], '%.1f' % result['peak_memory_mb'] if result['peak_memory_mb'] else 'unknown'))
+    for stage, stats in result['stages'].items():
+        old_stats = previous and previous['stages'].get(stage)
+        print('  %-10s p50 %8.3fms  p90 %8.3fms  p99 %8.3fms  max %8.3fms  total %9.1fms%s' % (
+            stage, stats['p50'], stats['p90'], stats['p99'], stats['max'], stats['total'],
+            change(stats['p50'], old_stats and old_stats['p50'])))
+    print('  resolved by: ' + ', '.join(tier + ' ' + str(count) for tier, count in result['tiers'].items()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the geolocation pipeline')
+    parser.add_argument('files', nargs='*', help='input csvs to benchmark (default data_to_geolocate/*.csv)')
+    parser.add_argument('--synthetic', type=int, metavar='ROWS', help='benchmark this many generated localities')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the generated localities')
+    parser.add_argument('--province', default='northern_cape', help='province for the generated localities')
+    parser.add_argument('--reference', choices=['snapshot', 'farms'],
+                        help='geolocate against the reference data snapshot (the default if gazetteer.csv is here) '
+                             'or just the surveyor general farms')
+    parser.add_argument('--batch-size', type=int, default=50)
+    parser.add_argument('--geocoder-latency', type=float, default=0, help='seconds each fake geocoder lookup takes')
+    parser.add_argument('--no-memo', action='store_true', help="don't remember matches for repeated localities")
+    parser.add_argument('--compare', action='store_true', help='compare with the last saved run over the same input')
+    parser.add_argument('--no-save', action='store_true', help="don't save the results")
+    parser.add_argument('--verbose', action='store_true', help="show the pipeline's own output")
+    args = parser.parse_args()
+
+    # The gazetteer doesn't ship with the repo, so without it use the farms, which do
+    if args.reference is None:
+        args.reference = 'snapshot' if os.path.exists('gazetteer.csv') else 'farms'
+        if args.reference == 'farms':
+            print('gazetteer.csv is missing, benchmarking against the surveyor general farms only')
+
+    if args.synthetic:
+        inputs = [('synthetic:%d:seed%d' % (args.synthetic, args.seed), Provinces[args.province],
+                   lambda: synthetic_localities(args.synthetic, args.seed))]
+    else:
+        inputs = [(path, province_for_file(path), lambda path=path: read_sample(path))
+                  for path in args.files or sorted(glob.glob('data_to_geolocate/*.csv'))]
+        for path, province, rows in inputs:
+            if province is None:
+                parser.error('can not tell which province ' + path + ' is for')
+
+    commit, dirty = current_commit()
+    for name, province, rows in inputs:
+        start = time.perf_counter()
+        databases, places = load_benchmark_databases(province, args.reference)
+        load_seconds = time.perf_counter() - start
+
+        # The fake geocoder knows some of the reference places, so there are hits and misses like google gives
+        batch_geocoder = BatchGeocoder(OfflineGeocoder.from_locations(places[::7], latency=args.geocoder_latency),
+                                       requests_per_second=None)
+        memo = None if args.no_memo else GeolocationMemo()
+
+        with contextlib.ExitStack() as stack:
+            if not args.verbose:
+                stack.enter_context(contextlib.redirect_stdout(open(os.devnull, 'w')))
+            start = time.perf_counter()
+            timings, tiers = run_pipeline(rows(), province, databases, batch_geocoder, memo=memo,
+                                          batch_size=args.batch_size)
+            seconds = time.perf_counter() - start
+
+        rows_done = len(timings['match'])
+        result = {'input': name, 'province': province.name, 'reference': args.reference, 'commit': commit,
+                  'dirty': dirty, 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+                  'numpy': numpy is not None, 'memo': not args.no_memo, 'batch_size': args.batch_size,
+                  'rows': rows_done, 'seconds': seconds, 'rows_per_second': rows_done / seconds if seconds else 0,
+                  'load_seconds': load_seconds, 'peak_memory_mb': peak_memory_mb(),
+                  'stages': {stage: summarise(stage_timings, scale=1000) for stage, stage_timings in timings.items()},
+                  'tiers': dict(tiers)}
+        print_result(result, previous_result(result) if args.compare else None)
+        if not args.no_save:
+            with open(RESULTS_FILE, 'a') as f:
+                f.write(json.dumps(result) + '\n')
@@ -0,0 +1,91 @@
+'''
+Distance and direction calculations done on whole arrays of points at once.
+Uses numpy if it's installed (pip install numpy), otherwise falls back to plain python loops which give the same
+answers, just more slowly.
+'''
+
+from math import asin, atan2, cos, degrees, radians, sin, sqrt
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def km_distance(a_lat, a_long, b_lat, b_long):
+    '''
+    The great circle (haversine) distance in km between two points
+    '''
+    a_lat, a_long, b_lat, b_long = map(radians, (float(a_lat), float(a_long), float(b_lat), float(b_long)))
+    h = sin((b_lat - a_lat) / 2) ** 2 + cos(a_lat) * cos(b_lat) * sin((b_long - a_long) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * asin(min(1.0, sqrt(h)))
+
+
+def km_distances(lat, long, lats, longs):
+    '''
+    The haversine distances in km from one point to each of the points in lats/longs
+    '''
+    if numpy is None:
+        return [km_distance(lat, long, b_lat, b_long) for b_lat, b_long in zip(lats, longs)]
+    lat, long = radians(float(lat)), radians(float(long))
+    lats = numpy.radians(numpy.asarray(lats, dtype=float))
+    longs = numpy.radians(numpy.asarray(longs, dtype=float))
+    h = numpy.sin((lats - lat) / 2) ** 2 + cos(lat) * numpy.cos(lats) * numpy.sin((longs - long) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * numpy.arcsin(numpy.minimum(1.0, numpy.sqrt(h)))
+
+
+def nearest(lat, long, locations):
+    '''
+    The location closest to the given point, ranking all of them in one go
+    '''
+    locations = list(locations)
+    distances = km_distances(lat, long, [x.lat for x in locations], [x.long for x in locations])
+    if numpy is None:
+        return locations[min(range(len(locations)), key=distances.__getitem__)]
+    return locations[int(numpy.argmin(distances))]
+
+
+def destinations(lats, longs, bearings, distances):
+    '''
+    Where you end up going each distance (km) along each bearing (degrees clockwise from north) from each point,
+    returned as (lats, longs)
+    '''
+    if numpy is None:
+        points = [_destination(*args) for args in zip(lats, longs, bearings, distances)]
+        return [point[0] for point in points], [point[1] for point in points]
+    lats = numpy.radians(numpy.asarray(lats, dtype=float))
+    longs = numpy.radians(numpy.asarray(longs, dtype=float))
+    bearings = numpy.radians(numpy.asarray(bearings, dtype=float))
+    angles = numpy.asarray(distances, dtype=float) / EARTH_RADIUS_KM
+    new_lats = numpy.arcsin(numpy.sin(lats) * numpy.cos(angles) +
+                            numpy.cos(lats) * numpy.sin(angles) * numpy.cos(bearings))
+    new_longs = longs + numpy.arctan2(numpy.sin(bearings) * numpy.sin(angles) * numpy.cos(lats),
+                                      numpy.cos(angles) - numpy.sin(lats) * numpy.sin(new_lats))
+    return numpy.degrees(new_lats).tolist(), numpy.degrees(new_longs).tolist()
+
+
+def _destination(lat, long, bearing, distance):
+    lat, long, bearing = radians(float(lat)), radians(float(long)), radians(float(bearing))
+    angle = float(distance) / EARTH_RADIUS_KM
+    new_lat = asin(sin(lat) * cos(angle) + cos(lat) * sin(angle) * cos(bearing))
+    new_long = long + atan2(sin(bearing) * sin(angle) * cos(lat), cos(angle) - sin(lat) * sin(new_lat))
+    return degrees(new_lat), degrees(new_long)
+
+
+def apply_directions(located):
+    '''
+    Moves a batch of geolocated locations by their directions in one go. Takes a list of (location, directions) pairs,
+    where directions is what the locality parser gives us, e.g., {'bearing': 45, 'distance': 10, ...}
+    '''
+    located = [(location, directions) for location, directions in located if location and directions]
+    if not located:
+        return
+    new_lats, new_longs = destinations([location.lat for location, directions in located],
+                                       [location.long for location, directions in located],
+                                       [directions['bearing'] for location, directions in located],
+                                       [directions['distance'] for location, directions in located])
+    for (location, directions), lat, long in zip(located, new_lats, new_longs):
+        location.lat = lat
+        location.long = long
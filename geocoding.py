@@ -0,0 +1,290 @@
+'''
+Wrappers around the remote geocoders (e.g., geopy's GoogleV3) we fall back on when a locality isn't in any of our
+databases: a persistent cache so re-runs don't repeat lookups, an offline stand-in so we can run without a network and
+a batch stage which sends all of the lookups for a run through a pool of workers
+'''
+
+import json, re, sqlite3, sys, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from fuzzywuzzy import utils
+
+
+class GeocodingFailed:
+    '''
+    What BatchGeocoder gives back for a query when every attempt raised an error (e.g., the network was down), as
+    opposed to None when the geocoder answered but found nothing. It's falsy, so code which only wants a result can
+    treat it like None.
+    '''
+    def __init__(self, error):
+        self.error = error
+
+    def __bool__(self):
+        return False
+
+
+class GeocodedResult:
+    '''
+    A geocoder result shaped like the geopy Location objects GoogleV3 returns, i.e., str() is the address and .raw is
+    the google response
+    '''
+    def __init__(self, address, raw):
+        self.address = address
+        self.raw = raw
+
+    @property
+    def latitude(self):
+        return self.raw['geometry']['location']['lat']
+
+    @property
+    def longitude(self):
+        return self.raw['geometry']['location']['lng']
+
+    def __str__(self):
+        return self.address
+
+
+def normalise_query(query, region=None):
+    '''
+    The key we cache a lookup under, so that "Springbok,  Northern cape" and "springbok, Northern Cape" are the same
+    '''
+    return re.sub(r'\s+', ' ', (query or '').strip().lower()) + '|' + (region or '').strip().lower()
+
+
+class GeocoderCache:
+    '''
+    Persists geocoder results (including "not found") in a local SQLite file.
+    Entries expire after ttl seconds (negative_ttl for not found) and the least recently used ones are evicted once
+    there are more than max_entries.
+    New entries and when each was last used are written to the file by flush (e.g., after each batch of lookups) or
+    once flush_every are waiting, rather than one transaction per lookup.
+    '''
+    def __init__(self, path='geocoder_cache.sqlite', ttl=90 * 24 * 3600, negative_ttl=7 * 24 * 3600,
+                 max_entries=100000, flush_every=500):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.flush_every = flush_every
+        self.hits = 0
+        self.misses = 0
+
+        # Waiting to be written, new entries as (address, raw, created, last_used) and hits as last_used
+        self.pending_entries = {}
+        self.pending_last_used = {}
+
+        # The batch geocoder uses this from several threads so serialise access to the connection
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS geocodes (key TEXT PRIMARY KEY, address TEXT, raw TEXT, '
+                                'created REAL, last_used REAL)')
+        self.connection.commit()
+
+    def get(self, query, region=None):
+        '''
+        Returns (True, result) if we have a fresh entry (result is None if the geocoder found nothing), otherwise
+        (False, None)
+        '''
+        key = normalise_query(query, region)
+        now = time.time()
+        with self.lock:
+            if key in self.pending_entries:
+                row = self.pending_entries[key][:3]
+            else:
+                row = self.connection.execute('SELECT address, raw, created FROM geocodes WHERE key = ?',
+                                              (key,)).fetchone()
+            if row:
+                address, raw, created = row
+                if now - created <= (self.ttl if raw is not None else self.negative_ttl):
+                    if key in self.pending_entries:
+                        self.pending_entries[key] = (address, raw, created, now)
+                    else:
+                        self.pending_last_used[key] = now
+                        self._flush_if_full()
+                    self.hits += 1
+                    return True, GeocodedResult(address, json.loads(raw)) if raw is not None else None
+            self.misses += 1
+            return False, None
+
+    def set(self, query, region, result):
+        key = normalise_query(query, region)
+        now = time.time()
+        raw = json.dumps(result.raw) if result is not None else None
+        address = str(result) if result is not None else None
+        with self.lock:
+            self.pending_entries[key] = (address, raw, now, now)
+            self.pending_last_used.pop(key, None)
+            self._flush_if_full()
+
+    def flush(self):
+        '''
+        Writes everything waiting to the SQLite file in one transaction and evicts the least recently used entries
+        '''
+        with self.lock:
+            self._flush()
+
+    def _flush_if_full(self):
+        if len(self.pending_entries) + len(self.pending_last_used) >= self.flush_every:
+            self._flush()
+
+    def _flush(self):
+        if not self.pending_entries and not self.pending_last_used:
+            return
+        self.connection.executemany('INSERT OR REPLACE INTO geocodes VALUES (?, ?, ?, ?, ?)',
+                                    [(key,) + entry for key, entry in self.pending_entries.items()])
+        self.connection.executemany('UPDATE geocodes SET last_used = ? WHERE key = ?',
+                                    [(last_used, key) for key, last_used in self.pending_last_used.items()])
+        if self.pending_entries:
+            self.connection.execute('DELETE FROM geocodes WHERE key IN (SELECT key FROM geocodes '
+                                    'ORDER BY last_used DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+        self.connection.commit()
+        self.pending_entries = {}
+        self.pending_last_used = {}
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            self.connection.close()
+
+
+class CachingGeocoder:
+    '''
+    Sits in front of a geocoder and only calls it for queries that aren't in the cache
+    '''
+    def __init__(self, geocoder, cache):
+        self.geocoder = geocoder
+        self.cache = cache
+
+    def geocode(self, query, region=None, **kwargs):
+        found, result = self.cached(query, region)
+        if found:
+            return result
+        return self.remember(query, region, self.geocoder.geocode(query=query, region=region, **kwargs))
+
+    def cached(self, query, region=None):
+        '''
+        (True, result) if the cache has an answer for the query, otherwise (False, None)
+        '''
+        return self.cache.get(query, region)
+
+    def remember(self, query, region, result):
+        '''
+        Caches what the geocoder gave back for a query and returns it in the form the cache would
+        '''
+        if result is not None:
+            result = GeocodedResult(str(result), result.raw)
+        self.cache.set(query, region, result)
+        return result
+
+    def flush(self):
+        self.cache.flush()
+
+
+class OfflineGeocoder:
+    '''
+    A stand-in for GoogleV3 which answers from a fixed set of places, so the pipeline can run (and be tested) without
+    a network. Set latency to make each lookup take that many seconds, like a remote call would.
+    '''
+    def __init__(self, places, latency=0):
+        # places maps a place name to (lat, long)
+        self.places = {utils.full_process(name, force_ascii=True): coordinates for name, coordinates in places.items()}
+        self.latency = latency
+        self.calls = 0
+
+    @classmethod
+    def from_locations(cls, locations, latency=0):
+        '''
+        Builds an offline geocoder from a list of Location objects, e.g., a gazetteer
+        '''
+        return cls({x.location.strip(): (x.lat, x.long) for x in locations}, latency=latency)
+
+    def geocode(self, query, region=None, **kwargs):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        # Queries look like "locality, Province", so try the whole thing then drop parts from the end
+        parts = query.split(',')
+        for i in range(len(parts), 0, -1):
+            name = ','.join(parts[:i])
+            coordinates = self.places.get(utils.full_process(name, force_ascii=True))
+            if coordinates:
+                lat, long = coordinates
+                address = name.strip() + ', South Africa'
+                return GeocodedResult(address, {
+                    'formatted_address': address,
+                    'address_components': [{'long_name': 'South Africa', 'short_name': 'ZA',
+                                            'types': ['country', 'political']}],
+                    'geometry': {'location': {'lat': lat, 'lng': long}, 'location_type': 'APPROXIMATE'}})
+        return None
+
+
+class RateLimiter:
+    '''
+    Spaces calls out so that no more than requests_per_second are made, however many threads are making them
+    '''
+    def __init__(self, requests_per_second):
+        self.interval = 1.0 / requests_per_second if requests_per_second else 0
+        self.next_call = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            call_at = max(now, self.next_call)
+            self.next_call = call_at + self.interval
+        if call_at > now:
+            time.sleep(call_at - now)
+
+
+class BatchGeocoder:
+    '''
+    Geocodes a whole batch of queries through a bounded pool of threads, with a limit on requests per second,
+    retries with exponential backoff and a timeout on each request.
+    For a CachingGeocoder the cache is checked first, so only the lookups which go to the remote geocoder are rate
+    limited and retried.
+    '''
+    def __init__(self, geocoder, max_workers=4, requests_per_second=10, retries=3, backoff=1, timeout=10):
+        self.geocoder = geocoder
+        self.max_workers = max_workers
+        self.rate_limiter = RateLimiter(requests_per_second)
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+    def geocode_all(self, queries):
+        '''
+        Takes a list of (query, region) pairs and returns the results in the same order, None where nothing was
+        found and a GeocodingFailed where every attempt failed. Repeated queries are only looked up once.
+        '''
+        unique_queries = list(dict.fromkeys(queries))
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = dict(zip(unique_queries, executor.map(self._geocode, unique_queries)))
+
+        # Caching geocoders write the whole batch's lookups out together
+        if hasattr(self.geocoder, 'flush'):
+            self.geocoder.flush()
+        return [results[query] for query in queries]
+
+    def _geocode(self, query_and_region):
+        query, region = query_and_region
+        caching = isinstance(self.geocoder, CachingGeocoder)
+        if caching:
+            found, result = self.geocoder.cached(query, region)
+            if found:
+                return result
+        for attempt in range(self.retries + 1):
+            self.rate_limiter.wait()
+            try:
+                if caching:
+                    return self.geocoder.remember(query, region, self.geocoder.geocoder.geocode(
+                        query=query, region=region, timeout=self.timeout))
+                return self.geocoder.geocode(query=query, region=region, timeout=self.timeout)
+            except Exception:
+                error = sys.exc_info()[1]
+                print("Error geocoding " + query + " (attempt " + str(attempt + 1) + "): " + str(error))
+                if attempt < self.retries:
+                    time.sleep(self.backoff * 2 ** attempt)
+        return GeocodingFailed(error)
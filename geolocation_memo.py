@@ -0,0 +1,154 @@
+'''
+Remembers what the databases found for each (cleaned locality, QDS, province) so that repeated localities, e.g., many
+"Ndumo Game Reserve, 2632CD" records, are only matched once. Recent entries are kept in memory and, optionally, every
+entry is persisted to a local SQLite file so later runs can reuse them too.
+'''
+
+import copy, json, os, re, sqlite3, threading
+from collections import OrderedDict
+from location import Location, FeatureTypes, MatchTiers, Provinces
+
+# Bump this when what's stored changes, so memos written by older code are thrown away
+MEMO_VERSION = 3
+
+# New entries are written to the SQLite file in one transaction when flush is called (e.g., after each batch of rows),
+# or once this many are waiting
+FLUSH_EVERY = 500
+
+
+def memo_file(path, name):
+    '''
+    The memo file for one reference snapshot (e.g., geolocation_memo_northern_cape.sqlite for path
+    geolocation_memo.sqlite), so runs against different snapshots don't keep throwing away each other's memos
+    '''
+    if not path:
+        return None
+    root, extension = os.path.splitext(path)
+    return root + '_' + name + extension
+
+
+def memo_key(locality):
+    '''
+    Everything (apart from the databases) that decides what a cleaned locality matches
+    '''
+    return '|'.join([re.sub(r'\s+', ' ', locality.location.strip().lower()), str(locality.qds).strip().upper(),
+                     locality.province.name, str(locality.farm_number), locality.feature_type.name])
+
+
+def _location_to_json(location):
+    return {'province': location.province.name, 'location': location.location, 'lat': location.lat,
+            'long': location.long, 'qds': location.qds, 'priority': location.priority, 'db_id': location.db_id,
+            'source': location.source, 'farm_number': location.farm_number,
+            'feature_type': location.feature_type.name, 'notes': location.notes}
+
+
+def _location_from_json(fields):
+    return Location(**dict(fields, province=Provinces[fields['province']],
+                           feature_type=FeatureTypes[fields['feature_type']]))
+
+
+class GeolocationMemo:
+    '''
+    An LRU cache of database matches holding up to max_entries in memory, backed by a SQLite file at path if given.
+    version should change whenever the reference data does (e.g., snapshot.reference_fingerprint) so that a persisted
+    memo built against other data is thrown away.
+    Every get returns new copies, so applying directions to a result never changes what's remembered.
+    New entries are only written to the file by flush (or once FLUSH_EVERY are waiting), so call it when a batch is
+    done and close at the end.
+    '''
+    def __init__(self, max_entries=10000, path=None, version=''):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = None
+        self.pending = {}
+        if path:
+            self.connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+            self.connection.execute('CREATE TABLE IF NOT EXISTS memo (key TEXT PRIMARY KEY, value TEXT)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+            row = self.connection.execute("SELECT value FROM meta WHERE name = 'version'").fetchone()
+            version = str(MEMO_VERSION) + ':' + version
+            if not row or row[0] != version:
+                self.connection.execute('DELETE FROM memo')
+                self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (version,))
+            self.connection.commit()
+
+    def get(self, locality):
+        '''
+        Returns None if we haven't seen this locality, False if the databases didn't have it, otherwise a copy of
+        (geolocated location, feature type, database name, matching tier, matched names)
+        '''
+        key = memo_key(locality)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                value = self.entries[key]
+            else:
+                value = self._load(key)
+                if value is None:
+                    self.misses += 1
+                    return None
+                self._remember(key, value)
+            self.hits += 1
+        if not value:
+            return False
+        location, feature_type, source, tier, matched_names = value
+        return copy.copy(location), feature_type, source, tier, list(matched_names)
+
+    def set(self, locality, matched):
+        key = memo_key(locality)
+        value = (copy.copy(matched[0]),) + tuple(matched[1:]) if matched else False
+        with self.lock:
+            self._remember(key, value)
+            if self.connection:
+                self.pending[key] = json.dumps([_location_to_json(value[0]), value[1].name, value[2], value[3].name,
+                                                value[4]] if value else False)
+                if len(self.pending) >= FLUSH_EVERY:
+                    self._flush()
+
+    def flush(self):
+        '''
+        Writes the entries set since the last flush to the SQLite file in one transaction
+        '''
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if self.connection and self.pending:
+            self.connection.executemany('INSERT OR REPLACE INTO memo VALUES (?, ?)', self.pending.items())
+            self.connection.commit()
+            self.pending = {}
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            if self.connection:
+                self.connection.close()
+                self.connection = None
+
+    def _remember(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _load(self, key):
+        if not self.connection:
+            return None
+        # It might have dropped out of memory before being written
+        if key in self.pending:
+            stored = self.pending[key]
+        else:
+            row = self.connection.execute('SELECT value FROM memo WHERE key = ?', (key,)).fetchone()
+            if not row:
+                return None
+            stored = row[0]
+        value = json.loads(stored)
+        if not value:
+            return False
+        return _location_from_json(value[0]), FeatureTypes[value[1]], value[2], MatchTiers[value[3]], value[4]
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,263 @@
+'''
+A Geolocator loads the reference data once and then geolocates as many localities as you like against it, so other
+tools can keep one warm in memory instead of running main.py each time, e.g.,
+    geolocator = Geolocator(Provinces.northern_cape)
+    geolocator.geolocate_one('10 km NE Vioolsdrif', '2817DC')
+    for result in geolocator.geolocate_batch(rows):
+        ...
+
+It can also be run as a small local HTTP server which takes JSON:
+    python geolocator.py --port 8000 --province northern_cape
+    curl -d '{"locality": "Farm Aggenys 56", "qds": "2918BB"}' http://localhost:8000/geolocate
+POST a single {"locality", "qds", "province"} object (province is optional if the server was started for one) or a list
+of them to /geolocate, GET /stats for the memo and geocoder cache statistics.
+'''
+
+import argparse, json, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import islice
+from location import Location, Provinces, find_province
+from distances import apply_directions
+from geocoding import BatchGeocoder, CachingGeocoder, GeocoderCache, OfflineGeocoder
+from geolocation_memo import GeolocationMemo, memo_file
+from instrumentation import record_size, record_timing
+from snapshot import load_national_snapshot, load_snapshot, reference_fingerprint, snapshot_name
+
+
+def make_locality(province, locality, qds):
+    '''
+    The Location for a row of input, starting off at the corner of its QDS. Raises a ValueError if the QDS is weird.
+    '''
+    qds = qds.strip()
+    try:
+        lat = -1 * float(qds[0] + qds[1])
+        long = float(qds[2] + qds[3])
+    except (IndexError, ValueError):
+        raise ValueError('ERROR with the qds ' + str(qds))
+    return Location(province=province, qds=qds, lat=lat, long=long, location=locality.strip())
+
+
+def geocode_remaining(results, batch_geocoder):
+    '''
+    Sends everything in a batch the databases couldn't find to the geocoder in one go and merges the results back in,
+    then applies the directions (e.g., 10 km NE of x) for the whole batch. results is a list of [locality, geolocated
+    location, ...] lists, the geolocated locations are updated in place.
+    '''
+    start = time.perf_counter()
+    pending = [result for result in results if result[0].needs_geocoder]
+    if batch_geocoder:
+        geocoded = batch_geocoder.geocode_all([result[0].geocoder_query() for result in pending])
+    else:
+        geocoded = [None] * len(pending)
+    for result, geocoder_result in zip(pending, geocoded):
+        result[1] = result[0].resolve_geocoder_result(geocoder_result, directions_in_bulk=True)
+    record_size('geocoder batch', len(pending))
+    record_timing('geocode batch', time.perf_counter() - start)
+
+    start = time.perf_counter()
+    apply_directions([(result[1], result[0].directions) for result in results])
+    record_timing('directions batch', time.perf_counter() - start)
+
+
+def to_result(locality, qds, province, geolocated_location, error=None):
+    '''
+    What we found for a locality as a dict that can be sent as JSON, with the same information as the output csv
+    '''
+    result = {'locality': locality, 'qds': qds, 'province': province.name if province else None,
+              'found': bool(geolocated_location)}
+    if error:
+        result['error'] = error
+    if geolocated_location:
+        result.update({'new_locality': geolocated_location.location,
+                       'latitude': geolocated_location.lat,
+                       'longitude': geolocated_location.long,
+                       'google_maps_link': 'http://www.google.co.za/maps/place/' + str(geolocated_location.lat) +
+                                           ',' + str(geolocated_location.long),
+                       'notes': geolocated_location.notes,
+                       'match_tier': geolocated_location.match_tier.value if geolocated_location.match_tier else ''})
+    return result
+
+
+class Geolocator:
+    '''
+    Owns the reference databases (and their indexes), the geolocation memo and the geocoder, and geolocates against
+    them. Give it a province to only load that province's reference data, otherwise it loads the whole country and
+    each locality needs its province.
+    geocoder is something with a geopy style geocode method (e.g., a CachingGeocoder around GoogleV3) used for what the
+    databases can't find, leave it out to only use the databases.
+    It's safe to use from several threads at once.
+    '''
+    def __init__(self, province=None, geocoder=None, memo_path=None, batch_size=50, geocoder_workers=4,
+                 requests_per_second=10):
+        self.province = province
+        if province:
+            province_databases, self.gazetteer = load_snapshot(province)
+            self.databases = {province: province_databases}
+        else:
+            self.databases, self.gazetteer = load_national_snapshot()
+        self.memo = GeolocationMemo(path=memo_file(memo_path, snapshot_name(province)),
+                                    version=reference_fingerprint(province))
+        self.batch_size = batch_size
+        self.use_geocoder(geocoder, geocoder_workers, requests_per_second)
+
+    def use_geocoder(self, geocoder, max_workers=4, requests_per_second=10):
+        '''
+        Changes the geocoder, e.g., to an OfflineGeocoder built from our own gazetteer once it's loaded
+        '''
+        self.geocoder = geocoder
+        self.batch_geocoder = BatchGeocoder(geocoder, max_workers=max_workers,
+                                            requests_per_second=requests_per_second) if geocoder else None
+
+    def _province(self, province):
+        # Provinces can be given by name (e.g., "Northern Cape" or "NC"), and default to the one we loaded
+        name = province
+        if province is None:
+            province = self.province
+        elif not isinstance(province, Provinces):
+            province = find_province(str(province))
+        if province is None:
+            raise ValueError('Unknown province ' + str(name))
+        if province not in self.databases:
+            raise ValueError('No reference data loaded for ' + province.name)
+        return province
+
+    def geolocate_one(self, locality, qds, province=None):
+        '''
+        Geolocates a single locality (e.g., "10 km NE Vioolsdrif") recorded in a QDS (e.g., "2817DC"), returning a
+        result dict like geolocate_batch's
+        '''
+        return next(self.geolocate_batch([{'locality': locality, 'qds': qds, 'province': province}]))
+
+    def geolocate_batch(self, rows):
+        '''
+        Geolocates rows (dicts with a locality, qds and optionally province) as they come, yielding a result dict for
+        each in the same order. Rows are matched against the databases a batch at a time, with whatever they can't find
+        sent to the geocoder together. A row that can't be geolocated (e.g., a bad QDS) gets an error instead.
+        Numbers are taken as strings (e.g., a qds of 2817 is '2817'), anything else that isn't a string gets an error.
+        '''
+        rows = iter(rows)
+        while True:
+            batch = list(islice(rows, self.batch_size))
+            if not batch:
+                return
+            results = []
+            for row in batch:
+                try:
+                    locality, qds = _text(row, 'locality'), _text(row, 'qds')
+                    province = self._province(_text(row, 'province') or None)
+                    location = make_locality(province, locality, qds)
+                except ValueError as e:
+                    results.append([None, None, row.get('locality'), row.get('qds'), None, str(e)])
+                    continue
+                results.append([location, location.geolocate(self.databases[province], google=None,
+                                                             directions_in_bulk=True, memo=self.memo),
+                                locality, qds, province, None])
+            self.memo.flush()
+            geocode_remaining([result for result in results if result[0]], self.batch_geocoder)
+            for location, geolocated_location, locality, qds, province, error in results:
+                if location and location.geocoder_failed:
+                    error = 'Could not reach the geocoder, try again later'
+                yield to_result(locality, qds, province, geolocated_location, error)
+
+    def stats(self):
+        return {'memo': self.memo.stats(),
+                'geocoder_cache': self.geocoder.cache.stats() if hasattr(self.geocoder, 'cache') else None}
+
+
+def _text(row, field):
+    # A field of a row as a string, '' if it's missing or null
+    value = row.get(field)
+    if value is None:
+        return ''
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    if not isinstance(value, str):
+        raise ValueError(field + ' should be a string')
+    return value
+
+
+class GeolocatorRequestHandler(BaseHTTPRequestHandler):
+    '''
+    Serves a Geolocator (the server's geolocator attribute) over HTTP with JSON requests and responses
+    '''
+    def do_POST(self):
+        # Whatever goes wrong the client gets a JSON error back rather than a dropped connection
+        try:
+            self._geolocate()
+        except Exception as e:
+            self.log_error('Error geolocating: %r', e)
+            self._send(500, {'error': 'Could not geolocate: ' + str(e)})
+
+    def _geolocate(self):
+        if self.path.rstrip('/') != '/geolocate':
+            return self._send(404, {'error': 'Not found'})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode('utf-8'))
+        except ValueError:
+            return self._send(400, {'error': 'The request should be JSON'})
+        rows = request if isinstance(request, list) else [request]
+        if not all(isinstance(row, dict) for row in rows):
+            return self._send(400, {'error': 'Send a {"locality", "qds", "province"} object or a list of them'})
+        try:
+            for row in rows:
+                for field in ('locality', 'qds', 'province'):
+                    _text(row, field)
+        except ValueError as e:
+            return self._send(400, {'error': str(e)})
+        results = list(self.server.geolocator.geolocate_batch(rows))
+        self._send(200, results if isinstance(request, list) else results[0])
+
+    def do_GET(self):
+        if self.path.rstrip('/') != '/stats':
+            return self._send(404, {'error': 'Not found'})
+        self._send(200, self.server.geolocator.stats())
+
+    def _send(self, status, response):
+        body = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(geolocator, host='127.0.0.1', port=8000):
+    server = ThreadingHTTPServer((host, port), GeolocatorRequestHandler)
+    server.geolocator = geolocator
+    print('Serving the geolocator on http://' + host + ':' + str(port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the geolocator over HTTP')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--province', help='only load this province (default the whole country)')
+    parser.add_argument('--geocoder', choices=['google', 'offline', 'none'], default='google',
+                        help='what to use for localities the databases can not find, offline uses the gazetteer')
+    parser.add_argument('--memo', default='geolocation_memo.sqlite',
+                        help='where to remember database matches, the snapshot name is added to it')
+    args = parser.parse_args()
+
+    province = find_province(args.province) if args.province else None
+    if args.province and not province:
+        parser.error('unknown province ' + args.province)
+    geolocator = Geolocator(province, memo_path=args.memo)
+
+    # Google maps geolocating API - https://github.com/geopy/geopy, cached like main.py's
+    if args.geocoder == 'google':
+        from geopy.geocoders import GoogleV3
+        geocoder = CachingGeocoder(GoogleV3(), GeocoderCache('geocoder_cache.sqlite'))
+    elif args.geocoder == 'offline':
+        # In its own cache, so the gazetteer's answers are never mistaken for google's
+        geocoder = CachingGeocoder(OfflineGeocoder.from_locations(geolocator.gazetteer),
+                                   GeocoderCache('offline_geocoder_cache.sqlite'))
+    else:
+        geocoder = None
+    geolocator.use_geocoder(geocoder)
+    serve(geolocator, args.host, args.port)
@@ -0,0 +1,157 @@
+'''
+Lets a run only re-geolocate the rows which could come out differently from last time, carrying everything else over
+from the previous output.
+
+Alongside an output csv we keep a record for each input row (output.csv.rows) holding a fingerprint of its input, the
+cleaned locality we searched for, the reference entries its match was chosen from and its output row, plus a digest of
+every reference entry the run used (output.csv.reference). The reference file also says which version of the records
+and output columns the run wrote, a run with different ones starts from scratch. Next time a row is carried over unless
+    - the geocoder couldn't be asked about it last time (e.g., the network was down),
+    - its input (locality, QDS or province) changed,
+    - one of the reference entries its match was chosen from changed or went away, or
+    - a reference entry which changed or is new would match its locality, i.e., could now beat what it found
+'''
+
+import hashlib, json, os
+from location import FeatureTypes, MatchTiers
+from geolocation_memo import MEMO_VERSION
+from geolocator import make_locality
+from indexes import make_database
+
+# Bump this when parsing or matching changes what a row geolocates to, or the records change, so older records aren't
+# carried over next to new results (MEMO_VERSION is part of it too)
+RECORDS_VERSION = 1
+
+# Rows found by these don't depend on the reference data at all
+REFERENCE_FREE_TIERS = (MatchTiers.qds, MatchTiers.coordinates)
+
+# Digests are cached for each reference store, since whole country runs share the gazetteer between provinces
+_digests_by_store = {}
+
+
+def records_path(output_csv):
+    return output_csv + '.rows'
+
+
+def reference_path(output_csv):
+    return output_csv + '.reference'
+
+
+def records_version(fieldnames):
+    '''
+    What a previous run has to have been written with for its records to be used
+    '''
+    return [RECORDS_VERSION, MEMO_VERSION, list(fieldnames)]
+
+
+def row_fingerprint(province, line):
+    '''
+    A hash of everything in an input row that decides what it geolocates to
+    '''
+    content = json.dumps([province.name, line['Locality'].strip(), line['Locus'].strip()])
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def reference_digests(databases):
+    '''
+    Maps 'database|name' to a short hash of every reference entry with that name (where it is, its QDS, priority,
+    source and so on), so two runs can tell which names' entries changed
+    '''
+    digests = {}
+    for database in databases:
+        store = database["db"]
+        # The store is kept with its digests so its id can't be reused by another one
+        if id(store) not in _digests_by_store or _digests_by_store[id(store)][0] is not store:
+            entries = {}
+            for location in store:
+                entries.setdefault(location.location.strip(), []).append(
+                    (location.lat, location.long, location.qds, location.priority, location.source,
+                     location.feature_type.name, str(location.db_id)))
+            _digests_by_store[id(store)] = (store, {
+                name: hashlib.sha1(json.dumps(sorted(name_entries)).encode('utf-8')).hexdigest()[:16]
+                for name, name_entries in entries.items()})
+        for name, digest in _digests_by_store[id(store)][1].items():
+            digests[database["name"] + '|' + name] = digest
+    return digests
+
+
+def load_previous_run(output_csv, version):
+    '''
+    The records of the last completed run for an output, by input fingerprint, and its reference digests. Returns
+    ({}, None) if there isn't one or it was written with another version (see records_version).
+    '''
+    try:
+        with open(reference_path(output_csv)) as f:
+            reference = json.load(f)
+        if not isinstance(reference, dict) or reference.get('version') != version:
+            return {}, None
+        digests = reference['digests']
+        records = {}
+        with open(records_path(output_csv)) as f:
+            for line in f:
+                record = json.loads(line)
+                if record:
+                    records[record['input']] = record
+    except (IOError, ValueError, KeyError):
+        return {}, None
+    return records, digests
+
+
+def save_reference_digests(output_csv, digests, version):
+    with open(reference_path(output_csv) + '.tmp', 'w') as f:
+        json.dump({'version': version, 'digests': digests}, f)
+    os.replace(reference_path(output_csv) + '.tmp', reference_path(output_csv))
+
+
+def make_record(input_fingerprint, locality, geolocated_location, output_row):
+    '''
+    What we need to remember about a row to decide whether to carry it over next time
+    '''
+    # A row we couldn't start on (e.g., a bad QDS) only comes out differently if its input changes
+    if locality is None:
+        return {'input': input_fingerprint, 'query': None, 'matched': [], 'retry': False, 'output': output_row}
+    tier = geolocated_location.match_tier if geolocated_location else None
+    return {'input': input_fingerprint,
+            'query': None if tier in REFERENCE_FREE_TIERS or not locality.location.strip() else locality.location,
+            'qds': locality.qds,
+            'farm_number': locality.farm_number,
+            'feature_type': locality.feature_type.name,
+            'matched': locality.matched_names,
+            'retry': locality.geocoder_failed,
+            'output': output_row}
+
+
+class ChangeDetector:
+    '''
+    Decides which records from the previous run are still good for a province, given the reference digests of that
+    run and of this one
+    '''
+    def __init__(self, province, databases, previous_digests, digests):
+        self.province = province
+        self.changed_names = {name for name in set(previous_digests) | set(digests)
+                              if previous_digests.get(name) != digests.get(name)}
+
+        # Small databases holding only the entries which changed or are new, to see if they'd match a row now
+        self.changed_databases = []
+        for database in databases:
+            changed = [location for location in database["db"]
+                       if database["name"] + '|' + location.location.strip() in self.changed_names]
+            if changed:
+                self.changed_databases.append(make_database(changed, database["feature_type"], database["name"]))
+
+    def is_current(self, record):
+        '''
+        Whether a record can be carried over as it is
+        '''
+        if record.get('retry'):
+            return False
+        if any(name in self.changed_names for name in record['matched']):
+            return False
+        if record['query'] is None or not self.changed_databases:
+            return True
+
+        # Search for the row's locality in just the changed entries, the same way geolocate would
+        locality = make_locality(self.province, record['query'], record['qds'])
+        locality.farm_number = record['farm_number']
+        locality.feature_type = FeatureTypes[record['feature_type']]
+        return not any(locality._geolocate_using_db(database) for database in self.changed_databases)
@@ -0,0 +1,259 @@
+'''
+Lookup structures built once per reference database so that each row we geolocate only has to look at a small
+set of candidate locations instead of scanning the whole database
+'''
+
+import re, unicodedata
+from bisect import bisect_left
+from collections import defaultdict
+from math import floor
+from fuzzywuzzy import fuzz, process, utils
+import instrumentation
+
+# How many quarter degree squares out from a record's QDS we search before widening to the whole database
+QDS_SEARCH_RADII = (1, 4)
+
+# Where each QDS letter sits in its square as (row, column), rows counting southwards and columns eastwards
+QDS_LETTER_OFFSETS = {'A': (0, 0), 'B': (0, 1), 'C': (1, 0), 'D': (1, 1)}
+
+# Queries shorter than this (once normalised) aren't looked up as the start of longer names, they'd match too many
+MIN_PREFIX_LENGTH = 4
+
+
+def make_database(locations, feature_type, name):
+    '''
+    Wraps a list of Location objects in the dict format Location.geolocate expects, along with its indexes
+    '''
+    return {"db": locations, "feature_type": feature_type, "name": name, "name_index": NameIndex(locations),
+            "qds_index": QdsIndex(locations), "farm_number_index": FarmNumberIndex(locations)}
+
+
+def qds_to_cells(qds):
+    '''
+    Converts a QDS string (e.g., 2632CD) into the set of quarter degree cells it covers as (row, column) pairs.
+    A degree square (2632) or half degree square (2632C) covers 16 or 4 cells, anything unreadable covers none.
+    '''
+    match = re.match(r'^\s*(\d\d)(\d\d)([A-Da-d])?([A-Da-d])?', qds or '')
+    if not match:
+        return set()
+    cells = {(int(match.group(1)) * 4, int(match.group(2)) * 4)}
+    for letter, size in ((match.group(3), 2), (match.group(4), 1)):
+        if letter:
+            row, column = QDS_LETTER_OFFSETS[letter.upper()]
+            cells = {(r + row * size, c + column * size) for r, c in cells}
+        else:
+            cells = {(r + row * size, c + column * size) for r, c in cells for row in (0, 1) for column in (0, 1)}
+    return cells
+
+
+def normalise_name(name):
+    '''
+    Lower case without accents, punctuation or extra spaces, e.g., "Môreson  Farm," becomes "moreson farm"
+    '''
+    name = ''.join(c for c in unicodedata.normalize('NFKD', name) if not unicodedata.combining(c))
+    return ' '.join(utils.full_process(name, force_ascii=True).split())
+
+
+def name_tokens(name):
+    '''
+    The distinct words of a normalised name in sorted order, so word order and repeats don't matter
+    '''
+    return tuple(sorted(set(name.split())))
+
+
+def lat_long_to_cell(lat, long):
+    '''
+    The quarter degree cell containing a point in the southern and eastern hemispheres
+    '''
+    return int(floor(-float(lat) * 4)), int(floor(float(long) * 4))
+
+
+def cell_to_qds(cell):
+    row, column = cell
+    letters = {offset: letter for letter, offset in QDS_LETTER_OFFSETS.items()}
+    return '%02d%02d%s%s' % (row // 4, column // 4, letters[(row % 4 // 2, column % 4 // 2)],
+                             letters[(row % 2, column % 2)])
+
+
+def neighbouring_cells(cells, radius):
+    '''
+    All of the cells within radius squares (including diagonally) of the given cells
+    '''
+    return {(row + i, column + j) for row, column in cells
+            for i in range(-radius, radius + 1) for j in range(-radius, radius + 1)}
+
+
+class NameIndex:
+    '''
+    A character trigram inverted index over the location names of a database.
+    Any name fuzzywuzzy would score 90 or above against a query shares at least one trigram with it, so we only
+    need to score the names that come out of the index rather than the whole database.
+    It also looks names up by their normalised form and by their words, which is all most clean localities need.
+    '''
+    def __init__(self, locations):
+        self.locations = locations
+
+        # Many farms share a name, so we score each distinct name once and keep track of where it is in the database
+        self.positions_by_name = defaultdict(list)
+        for position, location in enumerate(locations):
+            self.positions_by_name[location.location.strip()].append(position)
+        self.names = list(self.positions_by_name.keys())
+        self.name_ids = [0] * len(locations)
+        for name_id, name in enumerate(self.names):
+            for position in self.positions_by_name[name]:
+                self.name_ids[position] = name_id
+
+        # Map each trigram to the names which contain it
+        self.postings = defaultdict(set)
+        for name_id, name in enumerate(self.names):
+            for trigram in self._trigrams(name):
+                self.postings[trigram].add(name_id)
+
+        # Map normalised names and their sets of words to the names, and keep the normalised names sorted so we can
+        # find the ones starting with a query
+        self.name_ids_by_key = defaultdict(list)
+        self.name_ids_by_tokens = defaultdict(list)
+        for name_id, name in enumerate(self.names):
+            key = normalise_name(name)
+            self.name_ids_by_key[key].append(name_id)
+            self.name_ids_by_tokens[name_tokens(key)].append(name_id)
+        self.sorted_keys = sorted(self.name_ids_by_key.keys())
+
+    def __getstate__(self):
+        # Pickled (e.g., into a snapshot) without the database, which is stored separately and attached when loaded
+        return dict(self.__dict__, locations=None)
+
+    @staticmethod
+    def _trigrams(name):
+        # Use the same processing fuzzywuzzy applies before scoring, then pad each word so short words still count
+        trigrams = set()
+        for word in utils.full_process(name, force_ascii=True).split():
+            padded = ' ' + word + ' '
+            trigrams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+        return trigrams
+
+    def candidate_names(self, query, positions=None):
+        '''
+        Returns the names which share at least one trigram with the query, optionally only those found at the given
+        database positions
+        '''
+        name_ids = set()
+        for trigram in self._trigrams(query):
+            name_ids.update(self.postings.get(trigram, ()))
+        if positions is not None:
+            name_ids.intersection_update(self.name_ids[position] for position in positions)
+        return [self.names[name_id] for name_id in sorted(name_ids)]
+
+    def _locations_with_names(self, name_ids, positions=None):
+        # Every location with one of the names, in database order, optionally only those at the given positions
+        found = sorted(position for name_id in set(name_ids)
+                       for position in self.positions_by_name[self.names[name_id]]
+                       if positions is None or position in positions)
+        return [self.locations[position] for position in found]
+
+    def exact_matches(self, query, positions=None):
+        '''
+        The locations whose names are the same as the query once both are normalised (see normalise_name)
+        '''
+        key = normalise_name(query)
+        if not key:
+            return []
+        return self._locations_with_names(self.name_ids_by_key.get(key, ()), positions)
+
+    def token_matches(self, query, positions=None):
+        '''
+        The locations whose names have the same words as the query in any order (e.g., "Reserve, Ndumo Game"), or
+        start with the query's words (e.g., "Ndumo" for "Ndumo Game Reserve") where fuzzywuzzy scores the name 90 or
+        above. Its partial scores fall off for names much longer than the query, so "Kuru" doesn't find "Kuru River
+        Valley Cattle Ranch Estate" here any more than it would in extract_bests.
+        '''
+        key = normalise_name(query)
+        if not key:
+            return []
+        name_ids = list(self.name_ids_by_tokens.get(name_tokens(key), ()))
+        if len(key) >= MIN_PREFIX_LENGTH:
+            i = bisect_left(self.sorted_keys, key + ' ')
+            while i < len(self.sorted_keys) and self.sorted_keys[i].startswith(key + ' '):
+                name_ids.extend(name_id for name_id in self.name_ids_by_key[self.sorted_keys[i]]
+                                if fuzz.WRatio(query, self.names[name_id]) >= 90)
+                i += 1
+        return self._locations_with_names(name_ids, positions)
+
+    def extract_bests(self, query, score_cutoff=90, limit=5, positions=None):
+        '''
+        The equivalent of fuzzywuzzy's process.extractBests over the database (or just the given positions in it),
+        but returns Location objects
+        '''
+        candidates = self.candidate_names(query, positions)
+        if instrumentation.hooks:
+            instrumentation.record_size('fuzzy candidates', len(candidates))
+        if not candidates:
+            return []
+
+        # The limit counts database entries rather than distinct names (ties going to the earlier entry), the way
+        # it would over the whole database, but we return every location with one of the winning names
+        scored_entries = sorted((-score, position, name)
+                                for name, score in process.extractBests(query, candidates, score_cutoff=score_cutoff,
+                                                                        limit=None)
+                                for position in self.positions_by_name[name]
+                                if positions is None or position in positions)
+        best_names = []
+        for score, position, name in scored_entries[:limit]:
+            if name not in best_names:
+                best_names.append(name)
+        return [self.locations[position] for name in best_names for position in self.positions_by_name[name]
+                if positions is None or position in positions]
+
+
+class QdsIndex:
+    '''
+    Buckets the locations of a database by the quarter degree square their coordinates fall in, so we can look at
+    the locations near a record first and only widen the search when nothing nearby matches
+    '''
+    def __init__(self, locations):
+        self.positions_by_cell = defaultdict(list)
+        for position, location in enumerate(locations):
+            try:
+                self.positions_by_cell[lat_long_to_cell(location.lat, location.long)].append(position)
+            except (TypeError, ValueError):
+                continue
+
+    def positions_near(self, qds, radius=1):
+        '''
+        The database positions of every location within radius squares of the given QDS
+        '''
+        positions = set()
+        for cell in neighbouring_cells(qds_to_cells(qds), radius):
+            positions.update(self.positions_by_cell.get(cell, ()))
+        return positions
+
+
+class FarmNumberIndex:
+    '''
+    Maps farm numbers to the locations which have them, either in the name (e.g., La Cotte 736) or as the number
+    in a surveyor general reference (e.g., 2723CA_15)
+    '''
+    def __init__(self, locations):
+        self.locations = locations
+        self.positions_by_number = defaultdict(list)
+        for position, location in enumerate(locations):
+            numbers = set(int(number) for number in re.findall(r'\b(\d+)\b', location.location))
+            reference = re.match(r'^\s*\d{4}[A-Da-d]{0,2}_(\d+)\s*$', str(location.qds))
+            if reference:
+                numbers.add(int(reference.group(1)))
+            for number in numbers:
+                self.positions_by_number[number].append(position)
+
+    def __getstate__(self):
+        return dict(self.__dict__, locations=None)
+
+    def lookup(self, farm_number, qds_prefix=None):
+        '''
+        Returns the locations with this farm number, optionally only those whose QDS starts with qds_prefix
+        '''
+        try:
+            positions = self.positions_by_number.get(int(farm_number), [])
+        except (TypeError, ValueError):
+            return []
+        return [self.locations[position] for position in positions
+                if not qds_prefix or str(self.locations[position].qds).startswith(qds_prefix)]
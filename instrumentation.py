@@ -0,0 +1,172 @@
+'''
+Optional instrumentation for geolocating. Location.geolocate and its helpers report timings, counts and sizes to
+whatever hooks are registered here, and do nothing extra (beyond checking the list is empty) when there are none.
+
+A hook is anything with the methods of Hook. RunStats is the one main.py uses, it collects everything into a JSON
+report written next to the output csv, e.g.,
+    stats = RunStats()
+    with collecting(stats):
+        location.geolocate(databases, google)
+    stats.write('output_stats.json')
+'''
+
+import heapq, json, os
+from array import array
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+# The hooks currently listening
+hooks = []
+
+# How many of the slowest rows a report lists
+SLOWEST_ROWS = 20
+
+
+def add_hook(hook):
+    hooks.append(hook)
+
+
+def remove_hook(hook):
+    hooks.remove(hook)
+
+
+@contextmanager
+def collecting(hook):
+    '''
+    Registers a hook for the duration of a with block
+    '''
+    add_hook(hook)
+    try:
+        yield hook
+    finally:
+        remove_hook(hook)
+
+
+def record_timing(stage, seconds):
+    for hook in hooks:
+        hook.timing(stage, seconds)
+
+
+def record_size(name, size):
+    for hook in hooks:
+        hook.size(name, size)
+
+
+def record_count(counter, key, amount=1):
+    for hook in hooks:
+        hook.count(counter, key, amount)
+
+
+def record_row(locality, qds, seconds, outcome):
+    for hook in hooks:
+        hook.row(locality, qds, seconds, outcome)
+
+
+def summarise(values, scale=1):
+    '''
+    The count, median, 90th and 99th percentile, maximum and total of a list of numbers, each multiplied by scale
+    (e.g., 1000 to give timings in seconds as milliseconds)
+    '''
+    values = sorted(values)
+    if not values:
+        return {}
+
+    def at(fraction):
+        return values[min(len(values) - 1, int(fraction * len(values)))] * scale
+    return {'count': len(values), 'p50': at(0.5), 'p90': at(0.9), 'p99': at(0.99), 'max': values[-1] * scale,
+            'total': sum(values) * scale}
+
+
+class Hook:
+    '''
+    The calls a hook gets, override the ones you're interested in
+    '''
+    def timing(self, stage, seconds):
+        pass
+
+    def size(self, name, size):
+        pass
+
+    def count(self, counter, key, amount=1):
+        pass
+
+    def row(self, locality, qds, seconds, outcome):
+        pass
+
+
+class RunStats(Hook):
+    '''
+    Collects the timing of each stage, sizes (e.g., how many candidates were scored), counters (e.g., rows resolved by
+    each database and matching tier) and the slowest rows over a run.
+    Stats collected separately (e.g., in each worker process) can be combined with merge.
+    '''
+    def __init__(self):
+        self.timings = defaultdict(lambda: array('d'))
+        self.sizes = defaultdict(lambda: array('d'))
+        self.counters = defaultdict(Counter)
+        self.slowest = []
+        self.rows = 0
+
+    def __getstate__(self):
+        # defaultdicts of lambdas can't be pickled, which we need to send stats back from worker processes
+        return {'timings': dict(self.timings), 'sizes': dict(self.sizes), 'counters': dict(self.counters),
+                'slowest': self.slowest, 'rows': self.rows}
+
+    def __setstate__(self, state):
+        self.__init__()
+        self.timings.update(state['timings'])
+        self.sizes.update(state['sizes'])
+        self.counters.update(state['counters'])
+        self.slowest = state['slowest']
+        self.rows = state['rows']
+
+    def timing(self, stage, seconds):
+        self.timings[stage].append(seconds)
+
+    def size(self, name, size):
+        self.sizes[name].append(size)
+
+    def count(self, counter, key, amount=1):
+        self.counters[counter][key] += amount
+
+    def row(self, locality, qds, seconds, outcome):
+        self.rows += 1
+        self.counters['outcome'][outcome] += 1
+        self._keep_if_slow((seconds, locality, qds, outcome))
+
+    def _keep_if_slow(self, entry):
+        # The slowest rows are kept in a min heap, so the quickest of them is the one to drop
+        if len(self.slowest) < SLOWEST_ROWS:
+            heapq.heappush(self.slowest, entry)
+        elif entry > self.slowest[0]:
+            heapq.heapreplace(self.slowest, entry)
+
+    def merge(self, other):
+        for stage, timings in other.timings.items():
+            self.timings[stage].extend(timings)
+        for name, sizes in other.sizes.items():
+            self.sizes[name].extend(sizes)
+        for counter, counts in other.counters.items():
+            self.counters[counter].update(counts)
+        for entry in other.slowest:
+            self._keep_if_slow(entry)
+        self.rows += other.rows
+
+    def report(self, **extra):
+        '''
+        Everything collected as a dict which can be written as JSON (timings are in milliseconds), along with any extra
+        information about the run
+        '''
+        return dict({
+            'rows': self.rows,
+            'stages': {stage: summarise(timings, scale=1000) for stage, timings in sorted(self.timings.items())},
+            'sizes': {name: summarise(sizes) for name, sizes in sorted(self.sizes.items())},
+            'counters': {counter: dict(counts.most_common()) for counter, counts in sorted(self.counters.items())},
+            'slowest_rows': [{'locality': locality, 'qds': qds, 'milliseconds': seconds * 1000, 'outcome': outcome}
+                             for seconds, locality, qds, outcome in sorted(self.slowest, reverse=True)]}, **extra)
+
+    def write(self, path, **extra):
+        # Write to a temporary file first so the report is never half written
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.report(**extra), f, indent=2)
+        os.replace(path + '.tmp', path)
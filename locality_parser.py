@@ -0,0 +1,194 @@
+'''
+Parses a locality string (e.g., "Farm Aggenys 56" or "10 km NE of Vioolsdrif") into the name we should look up plus
+any directions, farm number or coordinates it contains.
+All of the patterns are compiled once at import so parsing is a small fixed cost per row.
+'''
+
+import re
+
+# Parks and reserves are often written in strange ways, and some stuff at the start is just noise
+CLEANING_SUBSTITUTIONS = [(re.compile(pattern), replacement) for pattern, replacement in [
+    (r'Nat\.?\s+[pP]ark\.?', 'National Park'),
+    (r'Nat\.?\s+[rR]es\.?', 'Nature Reserve'),
+    (r'\s+N\.?\s?R\.?\s+', 'Nature Reserve'),
+    (r'\s+N(at)?\.?\s?P(ark)?\.?\s+', 'National Park'),
+    # A lot of them have the string "snake collected from x"
+    (r'^\w+?\s*[cC]ollected\s+[fF]rom\s*', ''),
+    # I am not sure what this means but often things have K[letter]\d\d+ and that messes stuff up
+    (r'^\s+\d{3,4}K[RSTUV]\s+', ''),
+    # Some stuff in phrases is just useless and all that comes after it
+    (r'\s*(along the top of|at the bottom of|nearby|next to|in someone).*', ', '),
+    # A lot of things have been put in the proper address then a semi colon and random comments
+    (r';.+$', ''),
+]]
+
+# Measurement units and how many of them make a kilometer
+MEASUREMENT_UNITS = {'miles': (['miles', 'mile', 'mi'], 1 / 1.60934),
+                     'yards': (['yards', 'yard', 'yds', 'yd'], 1093.61),
+                     'kilometers': (['kilometers', 'kilometres', 'kilometer', 'kilometre', 'kmeters', 'kmetres',
+                                     'kmeter', 'kmetre', 'kms', 'km'], 1),
+                     'meters': (['meters', 'metres', 'meter', 'metre', 'ms', 'm'], 1000),
+                     'feet': (['feet', 'ft'], 3280.84)}
+UNIT_NAMES = {variation: name for name, (variations, per_km) in MEASUREMENT_UNITS.items() for variation in variations}
+
+# Compass points and the bearing in degrees they stand for
+COMPASS_POINTS = {'n': 0, 'nne': 22.5, 'ne': 45, 'ene': 67.5, 'e': 90, 'ese': 112.5, 'se': 135, 'sse': 157.5,
+                  's': 180, 'ssw': 202.5, 'sw': 225, 'wsw': 247.5, 'w': 270, 'wnw': 292.5, 'nw': 315, 'nnw': 337.5}
+BEARING_WORDS = {'north': 'n', 'south': 's', 'east': 'e', 'west': 'w',
+                 'northeast': 'ne', 'northwest': 'nw', 'southeast': 'se', 'southwest': 'sw'}
+BEARING_NAMES = (('south', 's'), ('north', 'n'), ('east', 'e'), ('west', 'w'))
+
+_units = '|'.join(sorted(UNIT_NAMES, key=len, reverse=True))
+# Two word bearings (north east, south-west) and dotted ones (N.E., s. w) come first, then the rest longest first
+_bearings = '|'.join([r'(?:north|south)[\s-]?(?:east|west)', r'[ns]\.?\s?[ew]\.?'] +
+                     sorted(list(BEARING_WORDS) + list(COMPASS_POINTS), key=len, reverse=True))
+DISTANCE = r'(\d+(?:[,\.]\d+)?)\s*(' + _units + r')\.?(?![a-z])'
+BEARING = r'(?<![\w-])(' + _bearings + r')\.?(?![\w-])'
+
+# e.g., "10 km NE of Vioolsdrif" or "Kruger National Park, 8km SE of Gudzani Dam"
+DIRECTIONS_PATTERN = re.compile(r'^(.*?)\s*' + DISTANCE + r'\s+(?:due\s+)?' + BEARING + r'\s*(?:of|fro?m)?\s*(.*)$',
+                                re.IGNORECASE)
+DISTANCE_PATTERN = re.compile(r'\s*' + DISTANCE, re.IGNORECASE)
+BEARING_PATTERN = re.compile(r'\s' + BEARING + r'(?=\s|$)', re.IGNORECASE)
+_filler = r'about|approx(?:imately)?|ca|circa|c|some|roughly|just'
+FILLER_PATTERN = re.compile(r'^[\W_]*((' + _filler + r')\b[\W_]*)*$', re.IGNORECASE)
+# What's left dangling on the end of "x, ca 20 km S of y" or "x (about 20 km S of y)" once the directions are cut off
+TRAILING_FILLER_PATTERN = re.compile(r'(?:[\s,;~\(\[\{]|\b(?:' + _filler + r')\b\.?)+$', re.IGNORECASE)
+OF_FROM_PATTERN = re.compile(r'\b([oO]f|[fF]ro?m)\b')
+EDGE_PUNCTUATION_PATTERN = re.compile(r'^[\s\.,;]+|[\s\.,;]+$')
+
+# Farms, e.g. "on the farm X", "Farm X, blah blah blah" and farm numbers like "La Cotte 736" or "Groothoek 278KQ"
+FARM_ON_PATTERN = re.compile(r'[\w\s]+?\s*[OoIi]n\s+(the\s+)?[Ff]arm\s*')
+FARM_PREFIX_PATTERN = re.compile(r'^\s*Farm\s*(.+?),.+')
+FARM_NUMBER_PATTERN = re.compile(r'\s*[\[\{\(]?\s*(?<![A-Za-z\d])(\d\d\d)(?!\d)(?!\s*(' + _units + r')\b)'
+                                 r'\s*[\]\}\)]?\s*', re.IGNORECASE)
+FARM_PATTERN = re.compile(r'\bfarm\b', re.IGNORECASE)
+
+# Degrees in the string, e.g., S 31d38m43s E 20d24m57s or 24 28 20.7 S, 27 36 28.6 E
+DEGREES_PATTERNS = [re.compile(r'\s[sS][\s\.](\d\d)[\s\.d](\d\d)[\s\.m](\d\d(?:\.\d+)?)s?\s*,?\s*'
+                               r'[eE][\s\.](\d\d)[\s\.d](\d\d)[\s\.m](\d\d(?:\.\d+)?)s?\s'),
+                    re.compile(r'\s(\d\d)[\s\.d\u00b0](\d\d)[\s\.m\'](\d\d(?:\.\d+)?)(?:s|")?\s*[sS]\s*,?\s*'
+                               r'(\d\d)[\s\.d\u00b0](\d\d)[\s\.m\'](\d\d(?:\.\d+)?)(?:s|")?\s*[eE]\s')]
+
+
+class ParsedLocality:
+    '''
+    Everything we could pull out of a locality string
+    '''
+    def __init__(self, location, distance=0, unit='', bearing=None, farm_number=0, is_farm=False, lat=None,
+                 long=None):
+        self.location = location
+        self.distance = distance
+        self.unit = unit
+        self.bearing = bearing
+        self.farm_number = farm_number
+        self.is_farm = is_farm
+        self.lat = lat
+        self.long = long
+
+    @property
+    def bearings(self):
+        '''
+        The cardinal directions that make up the bearing, e.g., SSE is ['south', 'east']
+        '''
+        if not self.bearing:
+            return []
+        return [name for name, letter in BEARING_NAMES if letter in self.bearing]
+
+    @property
+    def directions(self):
+        if self.distance and self.bearing:
+            return {'bearings': self.bearings, 'distance': self.distance,
+                    'bearing': COMPASS_POINTS[self.bearing]}
+        return False
+
+
+def parse_locality(location):
+    '''
+    Cleans a locality string and pulls out directions, farm numbers and coordinates in a single pass
+    '''
+    original = location
+    for pattern, replacement in CLEANING_SUBSTITUTIONS:
+        location = pattern.sub(replacement, location)
+
+    location, distance, unit, bearing = _parse_directions(location)
+    location, farm_number, is_farm = _parse_farm(location)
+    lat, long = _parse_degrees(original)
+    return ParsedLocality(location=EDGE_PUNCTUATION_PATTERN.sub('', location), distance=distance, unit=unit,
+                          bearing=bearing, farm_number=farm_number, is_farm=is_farm, lat=lat, long=long)
+
+
+def _distance_in_km(number, unit):
+    name = UNIT_NAMES[unit.lower()]
+    return float(number.replace(',', '.')) / MEASUREMENT_UNITS[name][1], name
+
+
+def _bearing_letters(bearing):
+    # e.g., "North-East", "north east" and "N. E." are all ne
+    bearing = re.sub(r'[^a-z]', '', bearing.lower())
+    return BEARING_WORDS.get(bearing, bearing)
+
+
+def _parse_directions(location):
+    '''
+    Returns the location without its directions, the distance in km, the unit it was given in and the bearing
+    '''
+    match = DIRECTIONS_PATTERN.match(location)
+    if match:
+        before, number, unit, bearing, after = match.groups()
+
+        # If there's something in front of it and something behind it, i.e., ^muizenberg, 20 km s of tokai$
+        # we really don't want to use the directions then, rather use the main thing and strip out the rest
+        if not FILLER_PATTERN.match(before) and after.strip():
+            return EDGE_PUNCTUATION_PATTERN.sub('', TRAILING_FILLER_PATTERN.sub('', before)), 0, '', None
+
+        distance, unit = _distance_in_km(number, unit)
+        remainder = after if after.strip() else before
+        return EDGE_PUNCTUATION_PATTERN.sub('', remainder), distance, unit, _bearing_letters(bearing)
+
+    # Otherwise the distance and bearing might be anywhere in the string, e.g., "Springbok 10 km, N"
+    distance_match = DISTANCE_PATTERN.search(location)
+    if not distance_match:
+        return location, 0, '', None
+    remainder = location[:distance_match.start()] + location[distance_match.end():]
+    bearing_match = BEARING_PATTERN.search(remainder)
+    if not bearing_match:
+        return location, 0, '', None
+    remainder = remainder[:bearing_match.start()] + ' ' + remainder[bearing_match.end():]
+    distance, unit = _distance_in_km(distance_match.group(1), distance_match.group(2))
+    remainder = OF_FROM_PATTERN.sub('', remainder)
+    return EDGE_PUNCTUATION_PATTERN.sub('', remainder), distance, unit, _bearing_letters(bearing_match.group(1))
+
+
+def _parse_farm(location):
+    '''
+    Returns the location with farm noise removed, the farm number if there is one and whether it's a farm
+    '''
+    location = FARM_ON_PATTERN.sub('Farm', location)
+    is_farm = bool(FARM_PATTERN.search(location))
+
+    # If this string contains three digits it's very likely to be a farm number
+    farm_number = 0
+    match = FARM_NUMBER_PATTERN.search(location)
+    if match:
+        location = location[:match.start()] + ' ' + location[match.end():]
+        farm_number = match.group(1)
+        is_farm = True
+
+    # Farm x, blah blah blah (we don't need the blah blah blah bit, so remove it and strip out the "Farm")
+    location = FARM_PREFIX_PATTERN.sub(r'\g<1>', location)
+    return location, farm_number, is_farm
+
+
+def _parse_degrees(location):
+    '''
+    Returns the decimal lat and long if the string has coordinates in it, otherwise None, None
+    '''
+    for pattern in DEGREES_PATTERNS:
+        match = pattern.search(' ' + location + ' ')
+        if match:
+            degrees = [float(group) for group in match.groups()]
+            lat = degrees[0] + degrees[1] / 60 + degrees[2] / 3600
+            long = degrees[3] + degrees[4] / 60 + degrees[5] / 3600
+            return -lat, long
+    return None, None
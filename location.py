@@ -1,9 +1,11 @@
-import re, sys
-from fuzzywuzzy import process
-from math import pow, sqrt, cos, radians
+import copy, difflib, os, re, sys
 from enum import Enum
-from geopy import Point
-from geopy.distance import distance, VincentyDistance
+from time import perf_counter
+import instrumentation
+from distances import apply_directions, km_distance, nearest
+from geocoding import GeocodingFailed
+from indexes import NameIndex, FarmNumberIndex, QDS_SEARCH_RADII
+from locality_parser import parse_locality
 
 
 class FeatureTypes(Enum):
@@ -18,6 +20,19 @@ class FeatureTypes(Enum):
     unknown = 'unknown'
 
 
+class MatchTiers(Enum):
+    '''
+    How a location was found, from the cheapest to the most expensive way of matching it
+    '''
+    qds = 'qds'
+    coordinates = 'coordinates'
+    farm_number = 'farm number'
+    exact = 'exact'
+    token = 'token'
+    fuzzy = 'fuzzy'
+    geocoder = 'geocoder'
+
+
 class Provinces(Enum):
     '''
     The provinces of SA
@@ -33,6 +48,29 @@ class Provinces(Enum):
     eastern_cape = ['SAF-EC', 'Eastern Cape', 'Eastern Cape?', 'EC']
 
 
+def find_province(name):
+    '''
+    Works out which province a name refers to, be it the province's name (e.g., northern_cape), one of the other names
+    it goes by (e.g., KZN) or a near miss (e.g., mpumulanga). Returns None if it doesn't look like any of them.
+    '''
+    name = re.sub(r'[^a-z]', '', name.lower())
+    names = {province.name.replace('_', ''): province for province in Provinces}
+    # The other names each province goes by, as long as only one province uses them
+    aliases = [(re.sub(r'[^a-z]', '', alias.lower()), province) for province in Provinces for alias in province.value]
+    for alias, province in aliases:
+        if alias == name and [other for a, other in aliases if a == alias] == [province]:
+            return province
+    match = difflib.get_close_matches(name, names.keys(), n=1, cutoff=0.8)
+    return names[match[0]] if match else None
+
+
+def province_for_file(path):
+    '''
+    Works out the province an input file is for from its name (e.g., freestate.csv)
+    '''
+    return find_province(os.path.splitext(os.path.basename(path))[0])
+
+
 class Location:
     def __init__(self, province, location, lat, long, qds, priority=0, db_id=0, source='', farm_number=0,
                  feature_type=FeatureTypes.unknown, notes=''):
@@ -51,87 +89,185 @@ class Location:
         self.farm_number = farm_number
         self.notes = notes
 
-    def geolocate(self, databases, google):  # parks, farms, gazetteer, google):
+        # Set while geolocating, these let the batch geocoding stage finish off what the databases couldn't find
+        self.directions = False
+        self.needs_geocoder = False
+        # Set if the geocoder couldn't be asked (as opposed to not finding it), so it's worth trying again later
+        self.geocoder_failed = False
+        self.match_tier = None
+        # The reference entries the match was chosen from, as 'database|name', so a later run can tell if it's affected
+        # when they change
+        self.matched_names = []
+
+    def geolocate(self, databases, google, directions_in_bulk=False, memo=None):  # parks, farms, gazetteer, google):
         '''
-        The set of steps we run through to try and geolocate a string
+        The set of steps we run through to try and geolocate a string.
+        With directions_in_bulk the directions aren't applied to what we find, the caller applies self.directions to a
+        whole batch at once with distances.apply_directions.
+        With a memo (a geolocation_memo.GeolocationMemo) repeated localities reuse what the databases found before.
+        Reports how long each step took, and how the location was found, to any instrumentation hooks.
         '''
-        # Clean the location string
-        self._clean_location()
+        if not instrumentation.hooks:
+            return self._geolocate(databases, google, directions_in_bulk, memo)
+
+        original_location = self.location
+        start = perf_counter()
+        geolocated_location = self._geolocate(databases, google, directions_in_bulk, memo)
+        if geolocated_location and geolocated_location.match_tier:
+            outcome = geolocated_location.match_tier.value
+        else:
+            outcome = 'waiting for geocoder' if self.needs_geocoder else 'not found'
+        instrumentation.record_row(original_location, self.qds, perf_counter() - start, outcome)
+        return geolocated_location
+
+    def _geolocate(self, databases, google, directions_in_bulk, memo):
+        # Clean the location string and pull out any directions, farm numbers and coordinates in it
+        start = perf_counter() if instrumentation.hooks else 0
+        parsed = parse_locality(self.location)
+        self.location = parsed.location
+        if instrumentation.hooks:
+            instrumentation.record_timing('parse', perf_counter() - start)
 
-        # If the loc is x km from something etc then try and get the location and clean the location string further
-        directions = self._get_directions()
+        # If the loc is x km from something etc then keep the directions to apply to whatever we find
+        directions = self.directions = parsed.directions
         if directions:
             print(directions)
 
-        # Check and see if it's a farm and clean up the name a bit more
-        if self._is_farm():
+        # Check and see if it's a farm
+        if parsed.is_farm:
             self.feature_type = FeatureTypes.farm
+            self.farm_number = parsed.farm_number
 
         # Does this cleaned location string contain something?
-        if self.location.strip() is '':
+        if self.location.strip() == '':
+            self.directions = False
             if self.lat is not None and self.long is not None:
+                self.match_tier = MatchTiers.qds
                 return self
             # else:
             # TODO if loc is blank then it needs to get the center from Fhatani's script (input qds) which he still has to write
             # But wait, can't we just use the original lat/long?
             return
 
-        # Try and get decimal degrees (e.g.,  31d38m43sS 20d24m57sE from the string if it exists use that as lat long)
-        if self._contains_degrees_in_location():
-            print('Found lat long in location: ' + self.lat + ' ' + self.long + ' ' + self.location)
+        # Did the string contain degrees (e.g.,  31d38m43sS 20d24m57sE)? If so use that as lat long
+        if parsed.lat is not None:
+            self.lat = parsed.lat
+            self.long = parsed.long
+            self.directions = False
+            self.match_tier = MatchTiers.coordinates
+            print('Found lat long in location: ' + str(self.lat) + ' ' + str(self.long) + ' ' + self.location)
             return self
 
-        # Try and see if we can find this location in one of the databases
-        for database in databases:
-            geolocated_location = self._geolocate_using_db(database["db"])
-            if geolocated_location:
-                self.feature_type = database["feature_type"]
-                self.source = database["name"]
-                if directions:
-                    geolocated_location._apply_directions(directions)
-                return geolocated_location
-
-        # If all else fails, try google
+        # Try and see if we can find this location in one of the databases, or remember what we found last time
+        matched = memo.get(self) if memo is not None else None
+        if memo is not None and instrumentation.hooks:
+            instrumentation.record_count('memo', 'miss' if matched is None else 'hit')
+        if matched is None:
+            matched = self._geolocate_using_databases(databases)
+            if memo is not None:
+                memo.set(self, matched)
+        if matched:
+            geolocated_location, self.feature_type, self.source, geolocated_location.match_tier, \
+                self.matched_names = matched
+            if directions and not directions_in_bulk:
+                geolocated_location._apply_directions(directions)
+            return geolocated_location
+
+        # If all else fails, try google (unless it's being left for the batch geocoding stage)
+        if google is None:
+            self.needs_geocoder = True
+            return
         geolocated_location = self._geolocate_using_google(google)
-        if directions:
+        if geolocated_location and directions and not directions_in_bulk:
             geolocated_location._apply_directions(directions)
         return geolocated_location
 
-    def _contains_degrees_in_location(self):
-        regex = '\s[sS][\s\.](\d\d)[\s\.d](\d\d)[\s\.m](\d\d)(\.\d+)?s?\s*,?\s*[eE][\s\.](\d\d)[\s\.d](\d\d)[\s\.m](\d\d)(\.\d+)?s?\s'
-        match = re.search(regex, self.location)
-        if match:
-            south = {'degrees': float(match.group(1)), 'minutes': float(match.group(2)), 'seconds': float(match.group(3))}
-            east = {'degrees': float(match.group(5)), 'minutes': float(match.group(6)), 'seconds': float(match.group(7))}
-            self.latitude = south['degrees'] + south['minutes'] / 60 + south['seconds'] / 3600
-            self.longitude = east['degrees'] + east['minutes'] / 60 + east['seconds'] / 3600
-            return True
-        else:
+    def _geolocate_using_databases(self, databases):
+        '''
+        Returns (geolocated location, feature type, database name, matching tier, names of the reference entries it was
+        chosen from) for the first database that has this location, otherwise False
+        '''
+        for database in databases:
+            start = perf_counter() if instrumentation.hooks else 0
+            matched = self._geolocate_using_db(database)
+            if instrumentation.hooks:
+                instrumentation.record_timing('database: ' + database["name"], perf_counter() - start)
+            if matched:
+                # Work on a copy so the directions don't move the database entry for every row after this one (or
+                # differently in each worker process)
+                geolocated_location, tier, matched_locations = matched
+                geolocated_location = copy.copy(geolocated_location)
+                # The gazetteer is shared by every province, so say which one this match is for
+                geolocated_location.province = self.province
+                if instrumentation.hooks:
+                    instrumentation.record_count('database', database["name"])
+                    instrumentation.record_count('tier', tier.value)
+                matched_names = sorted(set(database["name"] + '|' + x.location.strip() for x in matched_locations))
+                return geolocated_location, database["feature_type"], database["name"], tier, matched_names
+        return False
+
+    def resolve_geocoder_result(self, results, directions_in_bulk=False):
+        '''
+        Finishes geolocating a location the databases couldn't find, using a result from the batch geocoding stage
+        '''
+        self.needs_geocoder = False
+        if isinstance(results, GeocodingFailed):
+            print("Could not geocode " + self.location + ", will try again next time: " + str(results.error))
+            self.geocoder_failed = True
+            if instrumentation.hooks:
+                instrumentation.record_count('geocoder', 'error')
             return False
+        geolocated_location = self._apply_geocoder_result(results)
+        if instrumentation.hooks:
+            instrumentation.record_count('geocoder', 'found' if geolocated_location else 'not found')
+        if geolocated_location and self.directions and not directions_in_bulk:
+            geolocated_location._apply_directions(self.directions)
+        return geolocated_location
+
+    def _geolocate_using_db(self, database):
+        '''
+        Returns (best matched location, the matching tier which found it, all of the locations it was chosen from) or
+        False
+        '''
+        db = database["db"]
 
-    def _geolocate_using_db(self, db):
         # If we get a farm number try and get the location based on that (if we can't then continue on)
         if self.farm_number:
-            matched_locations = list(filter(lambda x: re.search(str(self.farm_number), db.location), db))
-            best_matched_location = self._get_best_matched_location(matched_locations)
-            if best_matched_location:
-                return best_matched_location
-
-        # Get a simple list of the location strings to use in the fuzzy matching
-        db_location_names = [x.location.strip() for x in db]
-
-        # Get the top matched locations in the same qds
-        results = process.extractBests(self.location, db_location_names, score_cutoff=90)
+            farm_number_index = database.get("farm_number_index") or FarmNumberIndex(db)
+            matched_locations = farm_number_index.lookup(self.farm_number, qds_prefix=self.qds[0:5]) or \
+                farm_number_index.lookup(self.farm_number)
+            if matched_locations:
+                return self._get_best_matched_location(matched_locations), MatchTiers.farm_number, matched_locations
+
+        name_index = database.get("name_index") or NameIndex(db)
+
+        # Look at the names near this record's QDS first and only widen the search if nothing matches
+        scopes = []
+        if database.get("qds_index") and self.qds:
+            scopes = [database["qds_index"].positions_near(self.qds, radius) for radius in QDS_SEARCH_RADII]
+        scopes = [positions for positions in scopes if positions] + [None]
+
+        # Try the cheap lookups first (the same name once normalised, then the same words or the start of a longer
+        # name) and only fuzzy score the names which plausibly match if they find nothing anywhere
+        tiers = [(MatchTiers.exact, name_index.exact_matches),
+                 (MatchTiers.token, name_index.token_matches),
+                 (MatchTiers.fuzzy, lambda query, positions: name_index.extract_bests(query, score_cutoff=90,
+                                                                                    positions=positions))]
+        for tier, find_matches in tiers:
+            start = perf_counter() if instrumentation.hooks else 0
+            for positions in scopes:
+                matched_locations = find_matches(self.location, positions=positions)
+                if matched_locations:
+                    break
+            if instrumentation.hooks:
+                instrumentation.record_timing('tier: ' + tier.value, perf_counter() - start)
+            if matched_locations:
+                if instrumentation.hooks:
+                    instrumentation.record_size('matched locations', len(matched_locations))
+                return self._get_best_matched_location(matched_locations), tier, matched_locations
 
         # If there aren't any then return false
-        if not results:
-            return False
-
-        # Otherwise convert back from simple names to full Location objects
-        matched_locations = [db[db_location_names.index(x[0])] for x in results]
-
-        # Return the best match
-        return self._get_best_matched_location(matched_locations)
+        return False
 
     def _get_best_matched_location(self, matched_locations):
         # If there are some locations in the correct qds then keep them and discard the others
@@ -155,33 +291,59 @@ class Location:
             # TODO
 
         # Finally, choose the one closest to the original location
-        return min(matched_locations, key=lambda x: self._get_km_distance_from_two_points(x.lat, x.long))
+        return nearest(self.lat, self.long, matched_locations)
+
+    def geocoder_query(self):
+        '''
+        The query and region we ask google (or a stand-in) for
+        '''
+        province_name = self.province.name.replace("_", " ").capitalize()
+        return self.location + ', ' + province_name, 'za'
 
     def _geolocate_using_google(self, google_geolocator):
+        start = perf_counter() if instrumentation.hooks else 0
         try:
-            province_name = self.province.name.replace("_", " ").capitalize()
-            results = google_geolocator.geocode(query=self.location + ', ' + province_name, region='za')
+            query, region = self.geocoder_query()
+            results = google_geolocator.geocode(query=query, region=region)
+        except:
+            print("ANOTHER ERROR occurred when looking up in google " + str(sys.exc_info()))
+            self.geocoder_failed = True
+            if instrumentation.hooks:
+                instrumentation.record_count('geocoder', 'error')
+            return False
+            # At this stage perhaps we should run it through bing or another map.
+        geolocated_location = self._apply_geocoder_result(results)
+        if instrumentation.hooks:
+            instrumentation.record_timing('geocoder', perf_counter() - start)
+            instrumentation.record_count('geocoder', 'found' if geolocated_location else 'not found')
+        return geolocated_location
+
+    def _apply_geocoder_result(self, results):
+        try:
+            if results is None:
+                print("Google maps could not find :" + self.location)
+                return False
 
             # Has it actually managed to find coords beyond province level? and are we in the right country?
+            province_name = self.province.name.replace("_", " ").capitalize()
             country = ''
             for address_component in results.raw['address_components']:
                 if address_component['types'] == ['country', 'political']:
                     country = address_component['short_name']
 
             if str(results) != province_name + ", South Africa" and country == 'ZA':
-                self.lat = results.raw['geometry']['location']['lat']
-                self.long = results.raw['geometry']['location']['lng']
+                lat = results.raw['geometry']['location']['lat']
+                long = results.raw['geometry']['location']['lng']
                 # We are finding the difference in x and y between a point (i.e., x degrees)
                 self.notes = "Google maps API geolocates this as: " + results.raw['geometry']['location_type'] + \
-                             " - distance from original qds = " + self._get_km_distance_from_two_points(self.lat, self.long)
+                             " - distance from original qds = " + str(self._get_km_distance_from_two_points(lat, long))
+                self.lat = lat
+                self.long = long
+                self.match_tier = MatchTiers.geocoder
                 return self
-        except AttributeError as e:
+        except (AttributeError, KeyError) as e:
             print("Google maps could not find :" + self.location + ' gives error : ' + str(sys.exc_info()))
             return False
-        except:
-            print("ANOTHER ERROR occurred when looking up in google " + str(sys.exc_info()))
-            return False
-            # At this stage perhaps we should run it through bing or another map.
 
     def _is_park(self):
         '''
@@ -189,148 +351,16 @@ class Location:
         '''
         return re.match('(National\s+Park|Nature\s+Reserve)', self.location, re.IGNORECASE)
 
-    def _get_directions(self):
-        # If there's something in front of it and something behind it, i.e., ^muizenberg, 20 km s of tokai$
-        # we really don't want to use the directions then, rather use the main thing and strip out the rest
-        main_regex = '\s*(\d\d*[,\.]?\d*)\s*(k?m|miles)\s+(([swne]{1,3})|south|no?rth|east|west)\s*(of|fro?m)?\s*'
-        m = re.search(r'^(.+?)' + re.escape(main_regex) + '(.+)$', self.location, re.IGNORECASE)
-        if m:
-            self.location = m.group(1)
-            return False
-
-        # We store the location variable and try and substitute stuff in it
-        location = self.location
-
-        # Look for digits and measurement units
-        measurement_units = {'miles': ['miles', 'mile', 'mi'],
-                             'yards': ['yard', 'yards'],
-                             'kilometers': ['km', 'kmeters', 'kmetres', 'kilometers', 'kmeter', 'kms', 'kmetre', 'kilometer'],
-                             'meters': ['m', 'meters', 'metres', 'meter', 'metre', 'ms'],
-                             'feet': ['ft', 'feet']}
-        distance = 0
-        measurement = ''
-        for name, variations in measurement_units.items():
-            for v in variations:
-                regex = '\s*(\d\d*[,\.]?\d*)\s*(' + v + ')'
-                substitute = re.search(regex, location, re.IGNORECASE)
-                temp = re.sub(regex, '', location, re.IGNORECASE)
-                if temp is not location:
-                    distance = float(substitute.group(1))
-                    measurement = name
-                    if variations == measurement_units['miles']:
-                        distance *= 1.60934
-                    elif variations is measurement_units['meters']:
-                        distance *= 1000
-                    elif variations is measurement_units['feet']:
-                        distance *= 3280.84
-                    elif variations is measurement_units['yards']:
-                        distance *= 1093.61
-                    location = temp
-                    break
-
-        # Look for bearings, keep track of the ones we need to remove and get rid of them afterwards
-        bearings_matches = {'south': ['south', 's', 'se', 'sw', 'south-east', 'southeast', 'south-west', 'southwest'],
-                            'north': ['north', 'n', 'ne', 'nw', 'north-east', 'northeast', 'north-west', 'northwest'],
-                            'east': ['east', 'e', 'se', 'ne', 'south-east', 'southeast', 'north-east', 'northeast'],
-                            'west': ['west', 'w', 'sw', 'nw', 'south-west', 'southwest', 'north-west', 'northwest']}
-        bearings = []
-        strings_to_remove = set()  # apparently keeps unique values only
-        for proper_name, match_list in bearings_matches.items():
-            for match in match_list:
-                regex = '\s(' + match + ')\.?(\s|$)'
-                temp = re.sub(regex, '', location, flags=re.IGNORECASE)
-                if temp is not location:
-                    bearings.append(proper_name)
-                    strings_to_remove.add(regex)
-
-        # Remove all of the applicable bearings
-        for regex in strings_to_remove:
-            location = re.sub(regex, '', location, flags=re.IGNORECASE)
-
-        # If we have bearings and distance and measurement we can make a sensible set of directions to return
-        if bearings and distance and measurement:
-            # Clean up the location string
-            location = re.sub('([oO]f|[fF]ro?m)', '', location)
-            location = re.sub('^\s*[\.,;]', '', location)
-            location = re.sub('\s*[\.,;]$', '', location)
-            self.location = location.strip()
-            return {'bearings': bearings, 'distance': distance}
-        else:
-            return False
-
     def _apply_directions(self, directions):
-        for bearing in directions['bearings']:
-            # Convert the bearing into something VincentyDistance understands:
-            if bearing == 'south':
-                bearing_degrees = 180
-            elif bearing == 'north':
-                bearing_degrees = 0
-            elif bearing == 'east':
-                bearing_degrees = 90
-            else:
-                bearing_degrees = 270
-
-            # Define starting point.
-            start = Point(self.lat, self.long)
-
-            # Use the `destination` method with a bearing of 0 degrees (which is north)
-            # in order to go from point `start` 1 km to north.
-            destination = VincentyDistance(kilometers=directions['distance']).destination(start, bearing_degrees)
-            self.lat = destination.latitude
-            self.long = destination.longitude
+        apply_directions([(self, directions)])
         return True
 
-    def _clean_location(self):
-        '''
-        Removes superfluous strings which just confuse stuff
-        '''
-        # National parks and nature reserves are often written in strange ways, let's correct them
-        self.location = re.sub(r'Nat\.?\s+[pP]ark\.?', 'National Park', self.location)
-        self.location = re.sub(r'Nat\.?\s+[rR]es\.?', 'Nature Reserve', self.location)
-        self.location = re.sub(r'\s+N\.?\s?R\.?\s+', 'Nature Reserve', self.location)
-        self.location = re.sub(r'\s+N(at)?\.?\s?P(ark)?\.?\s+', 'National Park', self.location)
-
-        # A lot of them have the string "snake collected from x", remove that
-        self.location = re.sub(r'^\w+?\s*[cC]ollected\s+[fF]rom\s*', '', self.location)
-
-        # I am not sure what this means but often things have K[letter]\d\d+ and that messes stuff up
-        self.location = re.sub(r'^\s+\d{3,4}K[RSTUV]\s+', '', self.location)
-
-        # Some stuff in phrases is just useless and all that comes after it, so remove
-        phrases = ['along the top of', 'at the bottom of', 'nearby', 'next to', 'in someone']
-        for phrase in phrases:
-            self.location = re.sub(r'\s*' + re.escape(phrase) + r'.*', ', ', self.location)
-
-        # A lot of things have been put in the proper address then a semi colon and random comments, so get rid of these
-        self.location = re.sub(r';.+$', '', self.location)
-
-    def _is_farm(self):
-        temp = self.location
-
-        # Remove "in the / on the" for farms
-        self.location = re.sub(r'[\w\s]+?\s*[OoIi]n\s+(the\s+)?[Ff]arm\s*', 'Farm', self.location)
-
-        # Farm x, blah blah blah (we don't need the blah blah blah bit, so remove it and strip out the "Farm"
-        self.location = re.sub(r'^\s*Farm\s*(.+?),.+', "\g<1>", self.location)
-
-        # If this string contains three digits it's very likely to be a farm number
-        # Alternate regex ^(([A-Za-z\-]+\s*?){1,4}),?\s?[\(\[\{]?(\d{3})[^\.].*$
-        results = re.search('\s*[\[\{\(]?\s*(\d\d\d)\s*[\]\}\)]?\s*', self.location, re.IGNORECASE)
-        if results and results.group(1):
-            self.location = self.location.replace(results.group(0), '')
-            self.farm_number = results.group(1)
-
-        # If anything has changed in the location string after this then it is a farm
-        return temp == self.location
-
     def _get_km_distance_from_two_points(self, a_lat, a_long, b_lat=None, b_long=None):
         if b_lat is None:
             b_lat = self.lat
         if b_long is None:
             b_long = self.long
-        lat_distance = (float(a_lat) - b_lat) * 110.54
-        long_distance = 111.32 * cos(float(a_long) - b_long)
-        return sqrt((pow(lat_distance, 2) + pow(long_distance, 2)))
+        return km_distance(a_lat, a_long, b_lat, b_long)
 
 
 class FarmLocation(Location):
@@ -1,117 +1,319 @@
 '''
 The following script iterates through an input csv and creates a geolocated location for each row
 It then prints the output in an output.csv
+With whole_country set it does every csv in data_to_geolocate/ in one go, printing each province's output in
+output_<province>.csv
 '''
 
 # Import the relevant libraries
-import csv
-from location import Location, Provinces, FeatureTypes
+import csv, glob, os, sys, time
+from collections import deque
+from contextlib import nullcontext
+from itertools import islice
+from multiprocessing import Pool
+from location import Provinces, province_for_file
+from geolocator import geocode_remaining, make_locality
+from geolocation_memo import GeolocationMemo, memo_file
+from incremental import (ChangeDetector, load_previous_run, make_record, records_path, records_version,
+                         reference_digests, row_fingerprint, save_reference_digests)
+from instrumentation import RunStats, collecting, record_row
+from output_writer import OutputWriter
+from snapshot import load_national_snapshot, load_snapshot, reference_fingerprint, snapshot_name
 
 # Change the province to geolocate other provinces
 province = Provinces.kwazulu_natal
 input_csv = 'data_to_geolocate/' + province.name + '.csv'
 
-# Collect all of the databases we will use for geolocating
-databases = []
-
-# The farms.csv contains a list of farms in SA with their coordinates from the Surveyor General in Wynberg
-farms_all = list(csv.reader(open('surveyor_general.csv')))
-farms = []
-for entry in farms_all:
-    if entry[6] in province.value:
-        farms.append(Location(db_id=entry[0], qds=entry[3].strip(), priority=1, lat=float(entry[4]),
-                              long=float(entry[5]), location=entry[1].strip(), province=province,
-                              feature_type=FeatureTypes.farm, source="Farms"))
-#databases.append({"db": farms, "feature_type": FeatureTypes.farm, "name": "Farms"})
-
-# The gazetteer_all has multiple sources which need prioritising
-gazetteer_all = list(csv.reader(open('gazetteer.csv')))
-gazetteer_source_priorities = list(csv.reader(open('gazetteer_source_priorities.csv')))
-gazetteer_source_priorities.sort(key=lambda x: x[3])
-gazetteer = []
-i = 0
-for entry in gazetteer_all:
-    #if entry[2] in province.value:
-    # Skip the first one, or if they haven't got a lat or long
-    if i == 0 or entry[7].strip() == '' or entry[6].strip() == '':
-        i += 1
-        continue
-    try:
-        g = Location(db_id=entry[0], qds=entry[3].strip(), province=province,
-                     source="Gazetteer - " + [x[0] for x in gazetteer_source_priorities if x[4] == entry[8]][0],
-                     priority=int([x[3] for x in gazetteer_source_priorities if x[4] == entry[8]][0]),
-                     lat=float(entry[7].strip()), long=float(entry[6].strip()), location=entry[1].strip())
-    except:
-        print(entry)
-        continue
-
-    gazetteer.append(g)
-databases.append({"db": gazetteer, "feature_type": FeatureTypes.unknown, "name": "Gazetteer"})
-
-# Google maps geolocating API - https://github.com/geopy/geopy
-from geopy.geocoders import GoogleV3
-google_geolocator = GoogleV3()
-# from geopy.geocoders import ArcGIS < This one times out
-# from geopy.geocoders import Bing < requires api key
-# from geopy.geocoders import YahooPlaceFinder < requires api key
-# from geopy.geocoders import Nominatim < service times out
-
-# Write the headers to the output file
-fieldnames = ['original_locality',
-              'original_qds',
-              'new_locality'
-              'latitude',
-              'longitude',
-              'precision',
-              'google_maps_link',
-              'notes']
-output_csv = 'output.csv'
-with open(output_csv, 'w', newline='') as newFile:
-    writer = csv.DictWriter(newFile, fieldnames=fieldnames)
-    writer.writeheader()
-
-# Run through the input file
-with open(input_csv, newline='') as csv_file:
-    line_reader = csv.DictReader(csv_file, delimiter=',', quotechar='"')
-
-    # Iterate over each location
-    for line in line_reader:
-        qds = line['Locus'].strip()
-        print('--')
-        print(line['Locality'])
-
-        # Get the original lat/long and raise an error if the QDS is weird
-        try:
-            lat = -1 * float(qds[0] + qds[1])
-            long = float(qds[2] + qds[3])
-        except:
-            print('ERROR with the qds ' + str(qds))
-            raise
+# Or geolocate every file in the input folder (working out each one's province from its name) in a single run, which
+# only loads the reference data once
+whole_country = False
+input_folder = 'data_to_geolocate'
+
+# Rows are geolocated in batches: matching against the databases is spread over this many processes (1 runs it all in
+# this one) and whatever the databases can't find is sent to the geocoder through a pool of threads
+processes = 1
+batch_size = 50
+geocoder_workers = 4
+geocoder_requests_per_second = 10
+
+# Carry on from the checkpoint if the last run on this input file was interrupted
+resume = True
+
+# Only geolocate the rows whose input or reference data changed since the last completed run on the same output,
+# carrying the rest over from it. A record of each row (output.csv.rows) and of the reference data
+# (output.csv.reference) is kept next to the output for the next run to compare against.
+incremental = False
+
+# Collect timings, counts and the slowest rows while geolocating, written to output_stats.json at the end
+collect_stats = True
+
+# What the databases found for each locality is remembered here so repeats (and re-runs) skip the matching, set to None
+# to only remember within a run. Each reference snapshot gets its own file, e.g., geolocation_memo_northern_cape.sqlite
+memo_path = 'geolocation_memo.sqlite'
+
+# The databases for each province are loaded once in the main process, forked worker processes share them rather than
+# loading their own
+databases = None
+memo = None
+
+
+def load_reference_data():
+    '''
+    Returns a dict of the databases for each province we're geolocating, the gazetteer and a fingerprint of the
+    reference data they came from. The whole country snapshot holds one copy of the gazetteer (and its indexes) which
+    every province shares.
+    '''
+    if whole_country:
+        databases_by_province, gazetteer = load_national_snapshot()
+        return databases_by_province, gazetteer, reference_fingerprint(None)
+    province_databases, gazetteer = load_snapshot(province)
+    return {province: province_databases}, gazetteer, reference_fingerprint(province)
+
+
+def _init_worker(fingerprint):
+    # Worker processes which weren't forked from the main process (e.g., on Windows) have to load their own
+    global databases, memo
+    if databases is None:
+        databases = load_reference_data()[0]
+    # Each process opens its own memo, SQLite connections can't be shared across a fork
+    memo = GeolocationMemo(path=memo_file(memo_path, _snapshot_name()), version=fingerprint)
+
+
+def _snapshot_name():
+    return snapshot_name(None if whole_country else province)
+
+
+def locate_in_databases(province_and_lines):
+    '''
+    Tries to geolocate a batch of input rows from one province using that province's databases only, returning
+    [locality, geolocated location, line, qds] for each in the same order, along with the stats collected along the
+    way (None unless collect_stats). Anything the databases can't find is left for the geocoder. A row whose QDS can't
+    be read gets None for its locality and location, so it's written as not found.
+    '''
+    line_province, lines = province_and_lines
+    results = []
+    batch_stats = RunStats() if collect_stats else None
+    with collecting(batch_stats) if batch_stats else nullcontext():
+        for line in lines:
+            qds = line['Locus'].strip()
+            print('--')
+            print(line['Locality'])
+
+            # Create a geolocated location object, starting from the QDS (if the QDS is weird there's nothing to start
+            # from, so count it and move on)
+            try:
+                locality = make_locality(line_province, line['Locality'], qds)
+            except ValueError as e:
+                print(str(e))
+                record_row(line['Locality'], qds, 0, 'bad qds')
+                results.append([None, None, line, qds])
+                continue
+            results.append([locality, locality.geolocate(databases[line_province], google=None,
+                                                         directions_in_bulk=True, memo=memo), line, qds])
+
+    # Write what this batch found to the memo file in one go
+    if memo:
+        memo.flush()
+    return results, batch_stats
+
+
+def batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
 
-        # Create a geolocated location object
-        locality = Location(province=province, qds=qds, lat=lat, long=long, location=line['Locality'].strip())
-        temp = locality.geolocate(databases, google=google_geolocator)
+def _geolocate_rows(file_province, input_csv, output_writer, run_stats, pool, batch_geocoder, previous_records=None,
+                    change_detector=None):
+    '''
+    Geolocates the rows of input_csv into output_writer. For incremental runs previous_records holds the last run's
+    record for each row by input fingerprint, and rows the change_detector says are still current are carried over.
+    '''
+    # Run through the input file, skipping any rows a previous run already did
+    with open(input_csv, newline='') as csv_file:
+        line_reader = csv.DictReader(csv_file, delimiter=',', quotechar='"')
+        line_reader = islice(line_reader, output_writer.rows_done, None)
+
+        # Batches are matched against the databases (in worker processes if we have them) a few at a time and wait
+        # here, in input order, with the records of the rows we're carrying over (None for the ones we're not). What to
+        # carry over is decided here rather than on a pool thread, so those lookups never end up in the run's stats.
+        keep_records = previous_records is not None
+        waiting_batches = deque()
+        for lines in batches(line_reader, batch_size):
+            fingerprints = [row_fingerprint(file_province, line) if keep_records else None for line in lines]
+            carried = [_carry_over(previous_records.get(fingerprint), change_detector) if keep_records else None
+                       for fingerprint in fingerprints]
+            province_lines = (file_province, [line for line, record in zip(lines, carried) if record is None])
+            located = pool.apply_async(locate_in_databases, (province_lines,)) if pool else \
+                locate_in_databases(province_lines)
+            waiting_batches.append((fingerprints, carried, located))
+
+            # Keep the workers busy without reading too far ahead of what's been written
+            if len(waiting_batches) > (2 * processes if pool else 0):
+                _write_batch(*waiting_batches.popleft(), pool, output_writer, run_stats, batch_geocoder, keep_records)
+        while waiting_batches:
+            _write_batch(*waiting_batches.popleft(), pool, output_writer, run_stats, batch_geocoder, keep_records)
+
+
+def _write_batch(fingerprints, carried, located, pool, output_writer, run_stats, batch_geocoder, keep_records):
+    '''
+    Geocodes whatever the databases couldn't find in a batch and writes every row of it, carried over or not, to the
+    output in input order
+    '''
+    results, batch_stats = located.get() if pool else located
+    if batch_stats:
+        run_stats.merge(batch_stats)
+    with collecting(run_stats) if run_stats else nullcontext():
+        geocode_remaining([result for result in results if result[0]], batch_geocoder)
+    results = iter(results)
+    for fingerprint, record in zip(fingerprints, carried):
+        if record is not None:
+            if run_stats:
+                run_stats.count('incremental', 'carried over')
+            output_writer.write(record['output'], record)
+            continue
 
         # Write the location object to the output csv
+        locality, temp, line, qds = next(results)
+        if run_stats and keep_records:
+            run_stats.count('incremental', 'geolocated')
         if temp:
             print(temp.location)
-            fieldnames = ['original_locality',
-              'original_qds',
-              'new_locality'
-              'latitude',
-              'longitude',
-              'precision',
-              'google_maps_link',
-              'notes']
-            with open(output_csv, 'a', newline='') as newFile:
-                writer = csv.writer(newFile, skipinitialspace=True)
-                writer.writerow([line['Locality'],
-                                 qds,
-                                 temp.location,
-                                 temp.lat,
-                                 temp.long,
-                                 '',
-                                 'http://www.google.co.za/maps/place/' + str(temp.lat) + ',' + str(temp.long),
-                                 temp.notes])
+            row = [line['Locality'],
+                   qds,
+                   temp.location,
+                   temp.lat,
+                   temp.long,
+                   '',
+                   'http://www.google.co.za/maps/place/' + str(temp.lat) + ',' + str(temp.long),
+                   temp.notes,
+                   temp.match_tier.value if temp.match_tier else '']
         else:
             print("Could not find location")
+            row = None
+        output_writer.write(row, make_record(fingerprint, locality, temp, row) if keep_records else None)
+
+
+def _carry_over(record, change_detector):
+    # The last run's record for a row if it can be used as it is, otherwise None
+    if record is None or change_detector is None or not change_detector.is_current(record):
+        return None
+    return record
+
+
+def geolocate_file(file_province, input_csv, output_csv, pool, batch_geocoder):
+    '''
+    Geolocates every row of an input csv for a province, writing the results to output_csv and (with collect_stats)
+    where the time went next to it
+    '''
+    # Write the output through one streaming writer, which checkpoints as it goes so an interrupted run can resume
+    fieldnames = ['original_locality',
+                  'original_qds',
+                  'new_locality',
+                  'latitude',
+                  'longitude',
+                  'precision',
+                  'google_maps_link',
+                  'notes',
+                  'match_tier']
+    run_stats = RunStats() if collect_stats else None
+    start = time.perf_counter()
+
+    # For incremental runs, work out which reference entries changed since the last completed run
+    previous_records = change_detector = digests = None
+    if incremental:
+        digests = reference_digests(databases[file_province])
+        previous_records, previous_digests = load_previous_run(output_csv, records_version(fieldnames))
+        if previous_digests is not None:
+            change_detector = ChangeDetector(file_province, databases[file_province], previous_digests, digests)
+            print(str(len(change_detector.changed_names)) + ' reference names changed since the last run')
+    output_writer = OutputWriter(output_csv, fieldnames, input_csv, resume=resume,
+                                 records_path=records_path(output_csv) if incremental else None)
+
+    # If anything goes wrong keep what we've done so far, along with its checkpoint
+    try:
+        _geolocate_rows(file_province, input_csv, output_writer, run_stats, pool, batch_geocoder, previous_records,
+                        change_detector)
+    except:
+        output_writer.close(complete=False)
+        raise
+    output_writer.close()
+    if incremental:
+        save_reference_digests(output_csv, digests, records_version(fieldnames))
+
+    # Write out where the time went next to the output
+    if run_stats:
+        seconds = time.perf_counter() - start
+        stats_path = os.path.splitext(output_csv)[0] + '_stats.json'
+        run_stats.write(stats_path, input_csv=input_csv, province=file_province.name, processes=processes,
+                        seconds=seconds, rows_per_second=run_stats.rows / seconds if seconds else 0,
+                        geocoder_cache=batch_geocoder.geocoder.cache.stats()
+                        if hasattr(batch_geocoder.geocoder, 'cache') else None)
+        print('Run statistics written to ' + stats_path)
+
+
+if __name__ == '__main__':
+    # The reference data comes from a memory mapped snapshot, which is (re)built from the csvs when they change
+    databases, gazetteer, fingerprint = load_reference_data()
+    if processes == 1:
+        memo = GeolocationMemo(path=memo_file(memo_path, _snapshot_name()), version=fingerprint)
+
+    # Google maps geolocating API - https://github.com/geopy/geopy
+    # Lookups are cached in a local SQLite file so re-runs don't repeat them (including the ones google couldn't find)
+    from geopy.geocoders import GoogleV3
+    from geocoding import BatchGeocoder, CachingGeocoder, GeocoderCache, OfflineGeocoder
+    google_geolocator = CachingGeocoder(GoogleV3(), GeocoderCache('geocoder_cache.sqlite'))
+    # To run without a network use the gazetteer as a stand-in for google, with its own cache so its answers never end
+    # up looking like google's
+    # google_geolocator = CachingGeocoder(OfflineGeocoder.from_locations(gazetteer),
+    #                                     GeocoderCache('offline_geocoder_cache.sqlite'))
+    # from geopy.geocoders import ArcGIS < This one times out
+    # from geopy.geocoders import Bing < requires api key
+    # from geopy.geocoders import YahooPlaceFinder < requires api key
+    # from geopy.geocoders import Nominatim < service times out
+
+    batch_geocoder = BatchGeocoder(google_geolocator, max_workers=geocoder_workers,
+                                   requests_per_second=geocoder_requests_per_second)
+
+    # Work out which files we're geolocating, for which province, and where each one's output goes
+    if whole_country:
+        inputs = []
+        for path in sorted(glob.glob(os.path.join(input_folder, '*.csv'))):
+            file_province = province_for_file(path)
+            if file_province is None:
+                print("Skipping " + path + ", can't tell which province it's for")
+                continue
+            output_csv = 'output_' + file_province.name + '.csv'
+            # Two files for the same province get an output each
+            if output_csv in [output for x, y, output in inputs]:
+                output_csv = 'output_' + os.path.splitext(os.path.basename(path))[0] + '.csv'
+            inputs.append((file_province, path, output_csv))
+    else:
+        inputs = [(province, input_csv, 'output.csv')]
+
+    # The same worker processes do every file
+    pool = Pool(processes, initializer=_init_worker, initargs=(fingerprint,)) if processes > 1 else None
+    for file_province, path, output_csv in inputs:
+        print('Geolocating ' + path + ' (' + file_province.name + ') into ' + output_csv)
+        try:
+            geolocate_file(file_province, path, output_csv, pool, batch_geocoder)
+        except Exception:
+            # Don't lose the rest of the country to one bad file, its checkpoint lets us carry on with it later
+            if not whole_country:
+                raise
+            print('ERROR geolocating ' + path + ', moving on to the next file: ' + str(sys.exc_info()))
+    if pool:
+        pool.close()
+        pool.join()
+
+    # How much work did the cache save us?
+    print('Geocoder cache: ' + str(google_geolocator.cache.stats()))
+    if memo:
+        print('Geolocation memo: ' + str(memo.stats()))
+        memo.close()
+    google_geolocator.cache.close()
@@ -0,0 +1,126 @@
+'''
+Writes the geolocated rows to the output csv through one open file, flushing in batches and recording a checkpoint
+after each flush so an interrupted run can carry on where it left off
+'''
+
+import csv, hashlib, json, os
+
+
+def file_hash(path):
+    '''
+    The sha1 of a file's contents
+    '''
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+class OutputWriter:
+    '''
+    Streams rows to output_csv. Every input row is passed to write() in order (None if it couldn't be geolocated) so
+    the checkpoint knows how many input rows are done.
+    With resume=True and a checkpoint for the same input file, rows_done says how many input rows to skip and
+    anything written after the last checkpoint is discarded so nothing ends up in the output twice.
+    With records_path, a JSON record for every input row (e.g., what incremental.py needs to carry it over next time)
+    is written alongside the output. The file at records_path is only replaced once the whole input is done.
+    '''
+    def __init__(self, output_csv, fieldnames, input_csv, resume=False, flush_every=50, records_path=None):
+        self.output_csv = output_csv
+        self.checkpoint_path = output_csv + '.checkpoint'
+        self.input_csv = input_csv
+        self.input_hash = file_hash(input_csv)
+        self.fieldnames = list(fieldnames)
+        self.flush_every = flush_every
+        self.buffer = []
+        self.rows_done = 0
+        self.rows_pending = 0
+        self.records_path = records_path
+        self.records_buffer = []
+        self.records_file = None
+
+        checkpoint = self._read_checkpoint() if resume else None
+        if checkpoint:
+            self.rows_done = checkpoint['rows_done']
+            self.file = open(output_csv, 'r+', newline='')
+            self.file.truncate(checkpoint['output_size'])
+            self.file.seek(checkpoint['output_size'])
+            self.writer = csv.writer(self.file, skipinitialspace=True)
+            if records_path:
+                self.records_file = open(records_path + '.partial', 'r+')
+                self.records_file.truncate(checkpoint['records_size'])
+                self.records_file.seek(checkpoint['records_size'])
+            print('Resuming from input row ' + str(self.rows_done))
+        else:
+            if records_path:
+                self.records_file = open(records_path + '.partial', 'w')
+            self.file = open(output_csv, 'w', newline='')
+            self.writer = csv.writer(self.file, skipinitialspace=True)
+            self.writer.writerow(fieldnames)
+            self.flush()
+
+    def _read_checkpoint(self):
+        # Only trust a checkpoint for this exact input file and output columns whose output is still there
+        try:
+            with open(self.checkpoint_path) as f:
+                checkpoint = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if checkpoint.get('input_csv') != self.input_csv or checkpoint.get('input_hash') != self.input_hash:
+            return None
+        if checkpoint.get('fieldnames') != self.fieldnames:
+            return None
+        if not os.path.exists(self.output_csv) or os.path.getsize(self.output_csv) < checkpoint['output_size']:
+            return None
+        if self.records_path and (checkpoint.get('records_size') is None or
+                                  not os.path.exists(self.records_path + '.partial') or
+                                  os.path.getsize(self.records_path + '.partial') < checkpoint['records_size']):
+            return None
+        return checkpoint
+
+    def write(self, row, record=None):
+        '''
+        Records the next input row as done, writing row to the output unless it's None (and record to the records)
+        '''
+        if row is not None:
+            self.buffer.append(row)
+        if self.records_file:
+            self.records_buffer.append(record)
+        self.rows_pending += 1
+        if self.rows_pending >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        self.writer.writerows(self.buffer)
+        self.buffer = []
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.rows_done += self.rows_pending
+        self.rows_pending = 0
+        if self.records_file:
+            self.records_file.writelines(json.dumps(record) + '\n' for record in self.records_buffer)
+            self.records_buffer = []
+            self.records_file.flush()
+            os.fsync(self.records_file.fileno())
+
+        # Write the checkpoint to a temporary file first so a crash can't leave half of one behind
+        checkpoint = {'input_csv': self.input_csv, 'input_hash': self.input_hash, 'rows_done': self.rows_done,
+                      'output_size': self.file.tell(), 'fieldnames': self.fieldnames,
+                      'records_size': self.records_file.tell() if self.records_file else None}
+        with open(self.checkpoint_path + '.tmp', 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(self.checkpoint_path + '.tmp', self.checkpoint_path)
+
+    def close(self, complete=True):
+        '''
+        Flushes whatever is left, once the whole input is done the checkpoint isn't needed any more
+        '''
+        self.flush()
+        self.file.close()
+        if self.records_file:
+            self.records_file.close()
+            if complete:
+                os.replace(self.records_path + '.partial', self.records_path)
+        if complete and os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
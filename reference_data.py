@@ -0,0 +1,105 @@
+'''
+Reads the reference csvs (surveyor general farms, gazetteer and its source priorities) into the databases we geolocate
+against. gazetteer_features.csv isn't read, the gazetteer has no feature column to look its categories up with.
+'''
+
+import csv
+from location import FeatureTypes
+from indexes import make_database
+from reference_store import ReferenceStore
+
+# The files the databases are built from, snapshot.py watches these to know when a snapshot is out of date
+SOURCE_FILES = ['surveyor_general.csv', 'gazetteer.csv', 'gazetteer_source_priorities.csv']
+
+# The reference csvs are exported as latin-1, so don't rely on the default encoding (utf-8 on most linux machines)
+ENCODING = 'latin-1'
+
+
+def load_source_priorities():
+    '''
+    Maps each gazetteer source id to its name and how much we trust it (lower is better)
+    '''
+    gazetteer_source_priorities = list(csv.reader(open('gazetteer_source_priorities.csv', encoding=ENCODING)))
+    gazetteer_source_priorities.sort(key=lambda x: x[3])
+
+    # If a source id turns up more than once the first one after sorting wins, skip any we can't make sense of
+    source_priorities = {}
+    for x in gazetteer_source_priorities:
+        try:
+            source_priorities.setdefault(x[4], (x[0], int(x[3])))
+        except (IndexError, ValueError):
+            continue
+    return source_priorities
+
+
+def load_farms_by_province(provinces):
+    '''
+    Reads the surveyor general farms once and splits them up by province, using each province's list of names. A farm
+    whose province name is used by more than one province (e.g., SAF-TV) goes into each of them.
+    '''
+    # The farms.csv contains a list of farms in SA with their coordinates from the Surveyor General in Wynberg
+    farms_all = list(csv.reader(open('surveyor_general.csv', encoding=ENCODING)))
+    farms = {province: ReferenceStore(province) for province in provinces}
+    provinces_by_name = {}
+    for province in provinces:
+        for name in province.value:
+            provinces_by_name.setdefault(name, []).append(province)
+    for entry in farms_all:
+        for province in provinces_by_name.get(entry[6], ()):
+            farms[province].append(db_id=entry[0], qds=entry[2].strip(), priority=1, lat=float(entry[4]),
+                                   long=float(entry[5]), location=entry[1].strip(), feature_type=FeatureTypes.farm,
+                                   source="Farms")
+    return farms
+
+
+def load_farms(province):
+    return load_farms_by_province([province])[province]
+
+
+def load_gazetteer(province=None):
+    # The gazetteer_all has multiple sources which need prioritising, it isn't split up by province so one copy can
+    # be shared by all of them
+    gazetteer_all = list(csv.reader(open('gazetteer.csv', encoding=ENCODING)))
+    source_priorities = load_source_priorities()
+    gazetteer = ReferenceStore(province)
+    i = 0
+    for entry in gazetteer_all:
+        #if entry[2] in province.value:
+        # Skip the first one, or if they haven't got a lat or long
+        if i == 0 or entry[7].strip() == '' or entry[6].strip() == '':
+            i += 1
+            continue
+        try:
+            source, priority = source_priorities[entry[8]]
+            gazetteer.append(db_id=entry[0], qds=entry[3].strip(), source="Gazetteer - " + source, priority=priority,
+                             lat=float(entry[7].strip()), long=float(entry[6].strip()), location=entry[1].strip())
+        except:
+            print(entry)
+            continue
+    return gazetteer
+
+
+def load_all_databases(provinces):
+    '''
+    Loads the databases for several provinces in one go, reading each csv once. Returns a dict of each province's
+    databases, which all share the one gazetteer database (and its indexes), along with the gazetteer.
+    '''
+    farms = load_farms_by_province(provinces)
+    gazetteer = load_gazetteer()
+    gazetteer_database = make_database(gazetteer, FeatureTypes.unknown, "Gazetteer")
+
+    # Collect all of the databases we will use for geolocating each province
+    databases = {}
+    for province in provinces:
+        databases[province] = []
+        #databases[province].append(make_database(farms[province], FeatureTypes.farm, "Farms"))
+        databases[province].append(gazetteer_database)
+    return databases, gazetteer
+
+
+def load_databases(province):
+    '''
+    Loads the databases we geolocate against, returning them along with the gazetteer (for the offline geocoder)
+    '''
+    databases, gazetteer = load_all_databases([province])
+    return databases[province], gazetteer
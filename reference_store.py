@@ -0,0 +1,144 @@
+'''
+A compact, column-oriented store for the reference databases (farms, gazetteer) so we don't need a full Location
+object for every row. Numbers live in parallel arrays and strings in an interned string table, and the store hands
+out lightweight views which only become real Location objects when they're copied, i.e., when they win a match.
+'''
+
+from array import array
+from location import Location, FeatureTypes
+
+FEATURE_TYPES = list(FeatureTypes)
+
+
+class StringTable:
+    '''
+    Stores each distinct string once and refers to it by number
+    '''
+    def __init__(self, strings=None):
+        self.strings = strings if strings is not None else []
+        self._ids = None
+
+    @property
+    def ids(self):
+        # Only needed while adding strings, so a table loaded from a snapshot builds it when first asked
+        if self._ids is None:
+            self._ids = {string: string_id for string_id, string in enumerate(self.strings)}
+        return self._ids
+
+    def add(self, string):
+        string_id = self.ids.get(string)
+        if string_id is None:
+            string_id = self.ids[string] = len(self.strings)
+            self.strings.append(string)
+        return string_id
+
+    def __getitem__(self, string_id):
+        return self.strings[string_id]
+
+
+class ReferenceStore:
+    '''
+    The rows of a reference database stored as columns
+    '''
+    # The name and array typecode of each column
+    COLUMNS = [('lats', 'd'), ('longs', 'd'), ('priorities', 'i'), ('feature_types', 'b'), ('names', 'i'),
+               ('qdss', 'i'), ('sources', 'i'), ('db_ids', 'i')]
+
+    def __init__(self, province):
+        self.province = province
+        self.strings = StringTable()
+        for column, typecode in self.COLUMNS:
+            setattr(self, column, array(typecode))
+
+    @classmethod
+    def from_columns(cls, province, columns, strings):
+        '''
+        Builds a store around existing columns, e.g., memoryviews onto a memory mapped snapshot, which can be read
+        but not appended to
+        '''
+        store = cls(province)
+        store.strings = StringTable(strings)
+        for column, typecode in cls.COLUMNS:
+            setattr(store, column, columns[column])
+        return store
+
+    def append(self, db_id, location, qds, lat, long, priority=0, source='', feature_type=FeatureTypes.unknown):
+        self.lats.append(lat)
+        self.longs.append(long)
+        self.priorities.append(priority)
+        self.feature_types.append(FEATURE_TYPES.index(feature_type))
+        self.names.append(self.strings.add(location))
+        self.qdss.append(self.strings.add(qds))
+        self.sources.append(self.strings.add(source))
+        self.db_ids.append(self.strings.add(str(db_id)))
+
+    def __len__(self):
+        return len(self.lats)
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [ReferenceView(self, i) for i in range(*position.indices(len(self)))]
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError('reference store index out of range')
+        return ReferenceView(self, position)
+
+    def __iter__(self):
+        for position in range(len(self)):
+            yield ReferenceView(self, position)
+
+
+class ReferenceView:
+    '''
+    Looks like a Location for matching purposes but just points at a row of a ReferenceStore.
+    Copying a view gives a standalone Location, which is what geolocate does with the winning match.
+    '''
+    __slots__ = ('store', 'position')
+
+    def __init__(self, store, position):
+        self.store = store
+        self.position = position
+
+    @property
+    def location(self):
+        return self.store.strings[self.store.names[self.position]]
+
+    @property
+    def qds(self):
+        return self.store.strings[self.store.qdss[self.position]]
+
+    @property
+    def lat(self):
+        return self.store.lats[self.position]
+
+    @property
+    def long(self):
+        return self.store.longs[self.position]
+
+    @property
+    def priority(self):
+        return self.store.priorities[self.position]
+
+    @property
+    def feature_type(self):
+        return FEATURE_TYPES[self.store.feature_types[self.position]]
+
+    @property
+    def source(self):
+        return self.store.strings[self.store.sources[self.position]]
+
+    @property
+    def db_id(self):
+        return self.store.strings[self.store.db_ids[self.position]]
+
+    @property
+    def province(self):
+        return self.store.province
+
+    def to_location(self):
+        return Location(province=self.province, location=self.location, lat=self.lat, long=self.long, qds=self.qds,
+                        priority=self.priority, db_id=self.db_id, source=self.source, feature_type=self.feature_type)
+
+    def __copy__(self):
+        return self.to_location()
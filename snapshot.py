@@ -0,0 +1,221 @@
+'''
+Compiles the reference csvs into a single binary snapshot per province (or one for the whole country), holding the
+columnar data and its prebuilt indexes, which is memory mapped at startup instead of parsing the csvs on every run.
+
+The snapshot records the size, modification time and sha1 of each source file it was built from, and is rebuilt
+automatically when any of them change. To build snapshots ahead of time run:
+    python snapshot.py kwazulu_natal limpopo ...
+or python snapshot.py all for the whole country snapshot.
+'''
+
+import hashlib, json, mmap, os, pickle, struct, sys
+from array import array
+from location import Provinces
+from output_writer import file_hash
+from reference_data import SOURCE_FILES, load_all_databases
+from reference_store import ReferenceStore
+
+SNAPSHOT_VERSION = 5
+MAGIC = b'GEOSNAP\x00'
+HEADER_LENGTH = struct.Struct('<Q')
+
+
+def snapshot_name(province=None):
+    # None means every province
+    return province.name if province else 'all'
+
+
+def snapshot_path(province=None):
+    return 'reference_data_' + snapshot_name(province) + '.snapshot'
+
+
+def _source_states(previous=None):
+    '''
+    The size, modification time and sha1 of each source file. Files whose size and time match previous (the states
+    stored in a snapshot) aren't hashed again.
+    '''
+    states = {}
+    for source_file in SOURCE_FILES:
+        if not os.path.exists(source_file):
+            states[source_file] = None
+            continue
+        stat = os.stat(source_file)
+        state = {'size': stat.st_size, 'mtime': stat.st_mtime}
+        old_state = (previous or {}).get(source_file)
+        if old_state and old_state['size'] == state['size'] and old_state['mtime'] == state['mtime']:
+            state['sha1'] = old_state['sha1']
+        else:
+            state['sha1'] = file_hash(source_file)
+        states[source_file] = state
+    return states
+
+
+def _aligned(length):
+    return (length + 7) // 8 * 8
+
+
+def build_snapshot(province=None, path=None):
+    '''
+    Parses the csvs and writes them, along with the databases' indexes, to a snapshot file for a province, or for
+    every province if province is None
+    '''
+    path = path or snapshot_path(province)
+    provinces = [province] if province else list(Provinces)
+    databases, gazetteer = load_all_databases(provinces)
+
+    # Every store the databases use, plus the gazetteer (which the offline geocoder needs even if it isn't used).
+    # Stores shared by several provinces' databases are only written once.
+    stores = {'gazetteer': gazetteer}
+    store_names = {id(gazetteer): 'gazetteer'}
+    for database_province in provinces:
+        for database in databases[database_province]:
+            if id(database["db"]) not in store_names:
+                name = database["name"].lower() + '_' + database_province.name
+                stores[name] = database["db"]
+                store_names[id(database["db"])] = name
+
+    # Lay out the raw bytes of each column and string table one after the other, 8 byte aligned
+    sections = []
+    offset = 0
+
+    def add_section(data):
+        nonlocal offset
+        sections.append(data + b'\x00' * (_aligned(len(data)) - len(data)))
+        section = [offset, len(data)]
+        offset += _aligned(len(data))
+        return section
+
+    store_headers = {}
+    for name, store in stores.items():
+        store_headers[name] = {
+            'province': store.province.name if store.province else None,
+            'length': len(store),
+            'columns': {column: add_section(getattr(store, column).tobytes()) for column, typecode in
+                        ReferenceStore.COLUMNS},
+            'strings': add_section(json.dumps(store.strings.strings).encode('utf-8'))}
+
+    # The databases (and their indexes) are pickled with their stores swapped for the store names, pickling them all
+    # in one go means indexes shared by several provinces are only stored once
+    pickled_databases = {database_province.name: [dict(database, db=store_names[id(database["db"])])
+                                                  for database in databases[database_province]]
+                         for database_province in provinces}
+    header = {'version': SNAPSHOT_VERSION,
+              'province': snapshot_name(province),
+              'sources': _source_states(),
+              'itemsizes': {typecode: array(typecode).itemsize for column, typecode in ReferenceStore.COLUMNS},
+              'stores': store_headers,
+              'databases': add_section(pickle.dumps(pickled_databases, protocol=pickle.HIGHEST_PROTOCOL))}
+
+    # Write to a temporary file first so a reader never sees half a snapshot
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = _aligned(len(MAGIC) + HEADER_LENGTH.size + len(header_bytes))
+    with open(path + '.tmp', 'wb') as f:
+        f.write(MAGIC)
+        f.write(HEADER_LENGTH.pack(len(header_bytes)))
+        f.write(header_bytes)
+        f.write(b'\x00' * (data_start - f.tell()))
+        for section in sections:
+            f.write(section)
+    os.replace(path + '.tmp', path)
+
+
+def _read_header(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            return None, 0
+        header_length, = HEADER_LENGTH.unpack(f.read(HEADER_LENGTH.size))
+        header = json.loads(f.read(header_length).decode('utf-8'))
+    return header, _aligned(len(MAGIC) + HEADER_LENGTH.size + header_length)
+
+
+def is_stale(province=None, path=None):
+    '''
+    Whether the snapshot is missing, from another version of this code or built from different source files
+    '''
+    path = path or snapshot_path(province)
+    if not os.path.exists(path):
+        return True
+    try:
+        header, data_start = _read_header(path)
+    except (IOError, ValueError, struct.error):
+        return True
+    if not header or header['version'] != SNAPSHOT_VERSION or header['province'] != snapshot_name(province):
+        return True
+    if header['itemsizes'] != {typecode: array(typecode).itemsize for column, typecode in ReferenceStore.COLUMNS}:
+        return True
+
+    # A file that's only been touched (e.g., copied) still matches on its hash
+    states = _source_states(header['sources'])
+    return any(states.get(source_file) is None or not header['sources'].get(source_file) or
+               states[source_file]['sha1'] != header['sources'][source_file]['sha1'] for source_file in SOURCE_FILES)
+
+
+def reference_fingerprint(province=None, path=None):
+    '''
+    A short hash identifying the reference data in a province's snapshot, which changes whenever the snapshot is
+    rebuilt from different source files (so anything derived from it, e.g., a geolocation memo, can be thrown away)
+    '''
+    header, data_start = _read_header(path or snapshot_path(province))
+    sources = {source_file: state and state['sha1'] for source_file, state in header['sources'].items()}
+    return hashlib.sha1(json.dumps([header['version'], header['province'], sources], sort_keys=True).encode('utf-8')
+                        ).hexdigest()
+
+
+def load_snapshot(province, path=None):
+    '''
+    Memory maps the snapshot for a province (building it first if it's missing or stale) and returns the databases
+    and the gazetteer, just like reference_data.load_databases
+    '''
+    databases, gazetteer = _load(province, path)
+    return databases[province], gazetteer
+
+
+def load_national_snapshot(path=None):
+    '''
+    Memory maps the whole country snapshot (building it first if it's missing or stale) and returns a dict of each
+    province's databases along with the gazetteer, just like reference_data.load_all_databases
+    '''
+    return _load(None, path)
+
+
+def _load(province, path):
+    path = path or snapshot_path(province)
+    if is_stale(province, path):
+        print('Building reference data snapshot ' + path)
+        build_snapshot(province, path)
+
+    header, data_start = _read_header(path)
+    with open(path, 'rb') as f:
+        buffer = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def section(offset_and_length):
+        offset, length = offset_and_length
+        return buffer[data_start + offset:data_start + offset + length]
+
+    # The columns are used straight from the mapped file, only the strings and indexes are unpacked
+    stores = {}
+    for name, store_header in header['stores'].items():
+        columns = {column: section(store_header['columns'][column]).cast(typecode)
+                   for column, typecode in ReferenceStore.COLUMNS}
+        strings = json.loads(bytes(section(store_header['strings'])).decode('utf-8'))
+        store_province = Provinces[store_header['province']] if store_header['province'] else None
+        stores[name] = ReferenceStore.from_columns(store_province, columns, strings)
+
+    # Shared databases come back as separate dicts for each province, but they still share their indexes
+    pickled_databases = pickle.loads(section(header['databases']))
+    databases = {}
+    for province_name, province_databases in pickled_databases.items():
+        for database in province_databases:
+            database["db"] = stores[database["db"]]
+            for key in ("name_index", "farm_number_index"):
+                if database.get(key):
+                    database[key].locations = database["db"]
+        databases[Provinces[province_name]] = province_databases
+    return databases, stores['gazetteer']
+
+
+if __name__ == '__main__':
+    for province_name in sys.argv[1:] or [province.name for province in Provinces]:
+        province = Provinces[province_name] if province_name != 'all' else None
+        build_snapshot(province)
+        print('Built ' + snapshot_path(province))
@@ -0,0 +1,33 @@
+import pytest
+from geopy.distance import great_circle
+import distances
+from distances import EARTH_RADIUS_KM, destinations, km_distance, km_distances
+
+POINTS = [(-29.66, 17.88), (-22.95, 31.1), (-34.36, 18.47), (-28.74, 24.77)]
+MOVES = [(0, 10), (45, 2.5), (90, 80), (202.5, 0.3), (315, 150)]
+
+
+@pytest.fixture(params=['numpy', 'plain python'])
+def maths(request, monkeypatch):
+    # Both ways of doing the sums should give geopy's answers
+    if request.param == 'plain python':
+        monkeypatch.setattr(distances, 'numpy', None)
+    elif distances.numpy is None:
+        pytest.skip('numpy is not installed')
+
+
+def test_distances_match_geopy(maths):
+    lat, long = POINTS[0]
+    expected = [great_circle((lat, long), point, radius=EARTH_RADIUS_KM).km for point in POINTS]
+    assert list(km_distances(lat, long, [p[0] for p in POINTS], [p[1] for p in POINTS])) == pytest.approx(expected)
+    assert km_distance(lat, long, *POINTS[1]) == pytest.approx(expected[1])
+
+
+def test_destinations_match_geopy(maths):
+    starts = [point for point in POINTS for move in MOVES]
+    moves = [move for point in POINTS for move in MOVES]
+    lats, longs = destinations([s[0] for s in starts], [s[1] for s in starts], [m[0] for m in moves],
+                               [m[1] for m in moves])
+    for start, (bearing, distance), lat, long in zip(starts, moves, lats, longs):
+        expected = great_circle(kilometers=distance, radius=EARTH_RADIUS_KM).destination(start, bearing)
+        assert (lat, long) == pytest.approx((expected.latitude, expected.longitude), abs=1e-9)
@@ -0,0 +1,16 @@
+import time
+from geocoding import BatchGeocoder, CachingGeocoder, GeocoderCache, OfflineGeocoder
+
+
+def test_cache_hits_are_not_rate_limited(tmp_path):
+    geocoder = OfflineGeocoder({'Springbok': (-29.66, 17.88)})
+    caching = CachingGeocoder(geocoder, GeocoderCache(str(tmp_path / 'cache.sqlite')))
+    queries = [('Springbok, Northern cape', 'za'), ('Nowhere, Northern cape', 'za')]
+    BatchGeocoder(caching, requests_per_second=1000).geocode_all(queries)
+
+    # Everything is cached now, so a slow rate limit shouldn't hold anything up or reach the geocoder
+    start = time.perf_counter()
+    results = BatchGeocoder(caching, requests_per_second=1).geocode_all(queries * 5)
+    assert time.perf_counter() - start < 0.5
+    assert geocoder.calls == 2
+    assert str(results[0]) == 'Springbok, South Africa' and results[1] is None
@@ -0,0 +1,87 @@
+import csv
+import main
+from geocoding import BatchGeocoder, OfflineGeocoder
+from indexes import make_database
+from location import FeatureTypes, Location, Provinces
+
+PROVINCE = Provinces.northern_cape
+PLACES = [('Springbok', '2917DB', -29.66, 17.88), ('Pofadder', '2919AD', -29.13, 19.39),
+          ('Kenhardt', '2921AC', -29.35, 21.15)]
+LOCALITIES = [('Springbok', '2917DB'), ('10 km N of Pofadder', '2919AD'), ('Kleinzee', '2917CA'),
+              ('Kenhardt', '2921AC')]
+
+
+class NetworkDown:
+    def geocode(self, query, region=None, **kwargs):
+        raise IOError('network down')
+
+
+def make_databases(places):
+    locations = [Location(province=None, location=name, qds=qds, lat=lat, long=long, db_id=i, priority=1,
+                          source='Gazetteer', feature_type=FeatureTypes.unknown)
+                 for i, (name, qds, lat, long) in enumerate(places)]
+    return {PROVINCE: [make_database(locations, FeatureTypes.unknown, 'Gazetteer')]}
+
+
+def geocoder(geocoder=None):
+    return BatchGeocoder(geocoder or OfflineGeocoder({'Kleinzee': (-29.68, 17.06)}), retries=0, backoff=0,
+                         requests_per_second=None)
+
+
+def run(tmp_path, monkeypatch, places, batch_geocoder, incremental=True, output='output.csv'):
+    '''
+    Geolocates LOCALITIES the way main.py does, returning the output rows and the localities that were geolocated
+    rather than carried over
+    '''
+    input_csv = tmp_path / 'northern_cape.csv'
+    with open(input_csv, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Locality', 'Locus'])
+        writer.writerows(LOCALITIES)
+
+    geolocated = []
+
+    def locate_in_databases(province_and_lines):
+        geolocated.extend(line['Locality'] for line in province_and_lines[1])
+        return located(province_and_lines)
+    located = main.locate_in_databases
+    monkeypatch.setattr(main, 'locate_in_databases', locate_in_databases)
+    monkeypatch.setattr(main, 'databases', make_databases(places))
+    monkeypatch.setattr(main, 'memo', None)
+    monkeypatch.setattr(main, 'incremental', incremental)
+    monkeypatch.setattr(main, 'collect_stats', False)
+
+    output_csv = str(tmp_path / output)
+    main.geolocate_file(PROVINCE, str(input_csv), output_csv, None, batch_geocoder)
+    with open(output_csv, newline='') as f:
+        return list(csv.reader(f)), geolocated
+
+
+def test_unchanged_rows_are_carried_over(tmp_path, monkeypatch):
+    first, geolocated = run(tmp_path, monkeypatch, PLACES, geocoder())
+    assert len(geolocated) == len(LOCALITIES)
+    second, geolocated = run(tmp_path, monkeypatch, PLACES, geocoder())
+    assert geolocated == []
+    assert second == first
+
+
+def test_changed_and_new_reference_entries_rerun_affected_rows(tmp_path, monkeypatch):
+    run(tmp_path, monkeypatch, PLACES, geocoder())
+
+    # Springbok moves and Kleinzee (which only the geocoder found before) is added
+    places = [('Springbok', '2917DB', -29.67, 17.89)] + PLACES[1:] + [('Kleinzee', '2917CA', -29.69, 17.07)]
+    output, geolocated = run(tmp_path, monkeypatch, places, geocoder())
+    assert sorted(geolocated) == ['Kleinzee', 'Springbok']
+
+    expected, geolocated = run(tmp_path, monkeypatch, places, geocoder(), incremental=False, output='full.csv')
+    assert output == expected
+
+
+def test_geocoder_failures_are_not_carried_over(tmp_path, monkeypatch):
+    output, geolocated = run(tmp_path, monkeypatch, PLACES, geocoder(NetworkDown()))
+    assert 'Kleinzee' not in [row[0] for row in output]
+
+    # Once the geocoder is back only the row it failed on is tried again
+    output, geolocated = run(tmp_path, monkeypatch, PLACES, geocoder())
+    assert geolocated == ['Kleinzee']
+    assert 'Kleinzee' in [row[0] for row in output]
@@ -0,0 +1,50 @@
+import csv, os
+from fuzzywuzzy import process
+from indexes import NameIndex
+from locality_parser import parse_locality
+from location import Location
+from reference_data import ENCODING
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def farms():
+    with open(os.path.join(REPO, 'surveyor_general.csv'), encoding=ENCODING) as f:
+        entries = list(csv.reader(f))[1:1001]
+    return [Location(province=None, location=entry[1], qds=entry[2], lat=float(entry[4]), long=float(entry[5]))
+            for entry in entries]
+
+
+def queries():
+    with open(os.path.join(REPO, 'data_to_geolocate', 'northern_cape.csv'), encoding=ENCODING) as f:
+        localities = [line['Locality'] for line in csv.DictReader(f)][:60]
+    return [parse_locality(locality.strip()).location for locality in localities] + \
+        ['Rooipan', 'Klipfontein', 'Brakpn', 'Leeuwkuil', 'Vaal']
+
+
+def distinct_names(locations):
+    return list(dict.fromkeys(location.location.strip() for location in locations))
+
+
+def test_extract_bests_matches_fuzzywuzzy():
+    locations = farms()
+    index = NameIndex(locations)
+    names = [location.location.strip() for location in locations]
+    for query in queries():
+        expected = [name for name, score in process.extractBests(query, names, score_cutoff=90, limit=5)]
+        assert distinct_names(index.extract_bests(query, score_cutoff=90, limit=5)) == \
+            list(dict.fromkeys(expected)), query
+
+
+def test_token_matches_are_ones_fuzzywuzzy_would_find():
+    names = ['Kuru River Valley Cattle Ranch Estate', 'Kuru Pan', 'Ndumo Game Reserve', 'Game Reserve Ndumo',
+             'Ndumo', 'Vaalbank', 'Vaal River', 'Kleinzee Diamond Area']
+    locations = farms() + [Location(province=None, location=name, qds='2917DB', lat=-29.6, long=17.8)
+                           for name in names]
+    index = NameIndex(locations)
+    all_names = [location.location.strip() for location in locations]
+    for query in queries() + ['Kuru', 'Ndumo', 'Reserve, Ndumo Game', 'Vaal', 'Kleinzee']:
+        found = set(distinct_names(index.token_matches(query)))
+        fuzzy = set(name for name, score in process.extractBests(query, all_names, score_cutoff=90, limit=None))
+        assert found <= fuzzy, query
+    assert distinct_names(index.token_matches('Kuru')) == ['Kuru Pan']
@@ -0,0 +1,43 @@
+import pytest
+from locality_parser import parse_locality
+
+# Localities from data_to_geolocate/ (and a few made up ones) with the name, distance (km) and bearing we should get
+CASES = [
+    ('10 km NE of Vioolsdrif', 'Vioolsdrif', 10, 'ne'),
+    ('28 km south west of Olifantshoek on N14 towards Upington', 'Olifantshoek on N14 towards Upington', 28, 'sw'),
+    ('Springbok, 10 km north east', 'Springbok', 10, 'ne'),
+    ('10 km N.E. of Springbok', 'Springbok', 10, 'ne'),
+    ('10 km SSE of Kenhardt', 'Kenhardt', 10, 'sse'),
+    ('Springbok 10 km, N', 'Springbok', 10, 'n'),
+    ('500 m W of Pofadder', 'Pofadder', 0.5, 'w'),
+    ('Richtersveld Park, ca 22 km E Sendelingsdrift', 'Richtersveld Park', 0, None),
+    ('Top of Helskloof, approx. 14 km NNE of Cornellskop, Richtersveld.', 'Top of Helskloof', 0, None),
+    ('Springbokvlakte ~ 50m East of Park sign number 9, Richtersveld National Park', 'Springbokvlakte', 0, None),
+    ('Kruger National Park, Riverview (17km E of Orpen Restcamp)', 'Kruger National Park, Riverview', 0, None),
+    ('Kruger Nat. Park', 'Kruger National Park', 0, None),
+]
+
+
+@pytest.mark.parametrize('locality, name, distance, bearing', CASES)
+def test_directions(locality, name, distance, bearing):
+    parsed = parse_locality(locality)
+    assert parsed.location == name
+    assert parsed.distance == pytest.approx(distance)
+    assert parsed.bearing == bearing
+
+
+def test_miles_are_converted_to_km():
+    assert parse_locality('3 miles S of Aggenys').distance == pytest.approx(3 * 1.60934)
+
+
+def test_farm_numbers():
+    parsed = parse_locality('Farm Aggenys 56, near the road')
+    assert parsed.is_farm
+    parsed = parse_locality('Groothoek 278KQ')
+    assert parsed.farm_number == '278' and parsed.is_farm
+
+
+def test_coordinates():
+    parsed = parse_locality('Richtersveld, 28 21 52 S, 17 14 12 E')
+    assert parsed.lat == pytest.approx(-(28 + 21 / 60 + 52 / 3600))
+    assert parsed.long == pytest.approx(17 + 14 / 60 + 12 / 3600)
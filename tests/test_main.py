@@ -0,0 +1,24 @@
+import csv
+import main
+from indexes import make_database
+from location import FeatureTypes, Location, Provinces
+
+
+def test_bad_qds_is_written_as_not_found(tmp_path, monkeypatch):
+    input_csv = str(tmp_path / 'free_state.csv')
+    with open(input_csv, 'w', newline='') as f:
+        csv.writer(f).writerows([['Locality', 'Locus'], ['Harrismith', '2829AC'], ['Harrismith', ''],
+                                 ['Bethlehem', '2828AB']])
+    places = [Location(province=None, location='Harrismith', qds='2829AC', lat=-28.27, long=29.13),
+              Location(province=None, location='Bethlehem', qds='2828AB', lat=-28.23, long=28.31)]
+    databases = [make_database(places, FeatureTypes.unknown, 'Gazetteer')]
+    monkeypatch.setattr(main, 'databases', {Provinces.free_state: databases})
+    monkeypatch.setattr(main, 'memo', None)
+    monkeypatch.setattr(main, 'incremental', False)
+    monkeypatch.setattr(main, 'collect_stats', False)
+
+    output_csv = str(tmp_path / 'output.csv')
+    main.geolocate_file(Provinces.free_state, input_csv, output_csv, None, None)
+    with open(output_csv, newline='') as f:
+        rows = list(csv.reader(f))
+    assert [(row[0], row[1]) for row in rows[1:]] == [('Harrismith', '2829AC'), ('Bethlehem', '2828AB')]
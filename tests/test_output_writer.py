@@ -0,0 +1,77 @@
+import json
+from output_writer import OutputWriter
+
+FIELDNAMES = ['original_locality', 'latitude']
+ROWS = [['Springbok', -29.66], None, ['Pofadder', -29.13], ['Kenhardt', -29.35], None, ['Kleinzee', -29.68],
+        ['Aggenys', -29.2], ['Upington', -28.45], None, ['Calvinia', -31.47]]
+
+
+def write_input(tmp_path):
+    input_csv = str(tmp_path / 'input.csv')
+    with open(input_csv, 'w') as f:
+        f.write('Locality,Locus\n' + ''.join(str(row) + ',2917DB\n' for row in ROWS))
+    return input_csv
+
+
+def records(row):
+    return {'output': row}
+
+
+def test_resume_after_partial_write_matches_uninterrupted_run(tmp_path):
+    input_csv = write_input(tmp_path)
+
+    # Everything in one go
+    expected_csv = str(tmp_path / 'expected.csv')
+    writer = OutputWriter(expected_csv, FIELDNAMES, input_csv, flush_every=3, records_path=expected_csv + '.rows')
+    for row in ROWS:
+        writer.write(row, records(row))
+    writer.close()
+
+    # Stop part way through with a row waiting to be flushed and a half written row after the checkpoint
+    output_csv = str(tmp_path / 'output.csv')
+    writer = OutputWriter(output_csv, FIELDNAMES, input_csv, resume=True, flush_every=3,
+                          records_path=output_csv + '.rows')
+    for row in ROWS[:7]:
+        writer.write(row, records(row))
+    writer.file.write('Half a ro')
+    writer.file.close()
+    writer.records_file.write('{"outp')
+    writer.records_file.close()
+
+    # Carry on from the checkpoint
+    writer = OutputWriter(output_csv, FIELDNAMES, input_csv, resume=True, flush_every=3,
+                          records_path=output_csv + '.rows')
+    assert writer.rows_done == 6
+    for row in ROWS[writer.rows_done:]:
+        writer.write(row, records(row))
+    writer.close()
+
+    with open(output_csv) as output, open(expected_csv) as expected:
+        assert output.read() == expected.read()
+    with open(output_csv + '.rows') as output, open(expected_csv + '.rows') as expected:
+        assert [json.loads(line) for line in output] == [json.loads(line) for line in expected]
+
+
+def test_checkpoint_for_other_input_or_columns_is_ignored(tmp_path):
+    input_csv = write_input(tmp_path)
+    output_csv = str(tmp_path / 'output.csv')
+    writer = OutputWriter(output_csv, FIELDNAMES, input_csv, resume=True, flush_every=3)
+    for row in ROWS[:4]:
+        writer.write(row)
+    writer.close(complete=False)
+
+    # Other output columns start again
+    writer = OutputWriter(output_csv, FIELDNAMES + ['notes'], input_csv, resume=True, flush_every=3)
+    assert writer.rows_done == 0
+    writer.close(complete=False)
+
+    # As does a changed input file
+    writer = OutputWriter(output_csv, FIELDNAMES, input_csv, resume=True, flush_every=3)
+    for row in ROWS[:4]:
+        writer.write(row)
+    writer.close(complete=False)
+    with open(input_csv, 'a') as f:
+        f.write('Kakamas,2820CB\n')
+    writer = OutputWriter(output_csv, FIELDNAMES, input_csv, resume=True, flush_every=3)
+    assert writer.rows_done == 0
+    writer.close()